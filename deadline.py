@@ -0,0 +1,60 @@
+import os
+import time
+
+# --- 設定: 実行全体の期限 ---
+# 期限はUNIX時刻 (秒) で環境変数に渡し、ワークフローの各ステップ (別プロセス) で共有する
+RUN_DEADLINE_ENV = "RUN_DEADLINE"
+
+
+class Deadline:
+    """
+    実行全体の期限。取得・計算・投稿の各段階に渡し、待ち時間やタイムアウトの上限に使う
+    expires_at が None の場合は期限なし
+    """
+
+    def __init__(self, expires_at=None):
+        self.expires_at = expires_at
+
+    @classmethod
+    def after(cls, seconds):
+        """今から seconds 秒後を期限とする (None なら期限なし)"""
+        if seconds is None:
+            return cls(None)
+        return cls(time.time() + seconds)
+
+    @classmethod
+    def from_env(cls, default_seconds=None):
+        """環境変数 RUN_DEADLINE (UNIX時刻) から期限を読む。未設定なら default_seconds 秒後"""
+        value = os.environ.get(RUN_DEADLINE_ENV)
+        if value:
+            try:
+                return cls(float(value))
+            except ValueError:
+                print(f"警告: {RUN_DEADLINE_ENV} の値が不正です: {value}")
+        return cls.after(default_seconds)
+
+    def reserve(self, seconds):
+        """後工程のために seconds 秒を残した、より早い期限を返す"""
+        if self.expires_at is None:
+            return Deadline(None)
+        return Deadline(self.expires_at - seconds)
+
+    def remaining(self):
+        """残り時間 (秒)。期限なしなら None"""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.time())
+
+    def expired(self):
+        return self.expires_at is not None and time.time() >= self.expires_at
+
+    def timeout(self, default=None, minimum=0.0):
+        """
+        個々の待ち・通信に使うタイムアウト: default と残り時間の小さい方 (minimum 未満にはしない)
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return default
+        value = remaining if default is None else min(default, remaining)
+        return max(minimum, value)
+
@@ -0,0 +1,527 @@
+import asyncio
+import json
+import os
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from deadline import Deadline
+
+# --- 設定: 非同期取得エンジン ---
+DEFAULT_CONCURRENCY = 5      # 同時実行数の上限
+DEFAULT_RATE = 10.0          # トークンバケットの補充速度 (リクエスト/秒)
+DEFAULT_BURST = 10           # トークンバケットの容量 (瞬間的に許容するリクエスト数)
+DEFAULT_MAX_RETRIES = 3      # 初回を除く再試行回数
+DEFAULT_TIMEOUT = 30.0       # 1リクエストあたりのタイムアウト (秒)
+BACKOFF_BASE = 0.5           # 指数バックオフの初期待ち時間 (秒)
+BACKOFF_MAX = 8.0            # 指数バックオフの上限 (秒)
+AIMD_MAX_CONCURRENCY = 32    # 適応制御で上げられる並行数の上限
+AIMD_LATENCY_TOLERANCE = 2.0 # 直近レイテンシの中央値が基準のこの倍数を超えたら並行数を下げる
+AIMD_LATENCY_WINDOW = 20     # 直近レイテンシの中央値をとる成功数 (1回だけの遅い応答では下げない)
+AIMD_BASELINE_WINDOWS = 10   # 基準レイテンシ = 直近この数の区間 (AIMD_LATENCY_WINDOW 件ずつ) の中央値の最小値
+AIMD_THROTTLE_RATIO = 0.5    # 429 (スロットリング) を受けたときの並行数の倍率
+AIMD_ERROR_RATIO = 0.75      # その他のエラー・タイムアウト時の並行数の倍率
+AIMD_LATENCY_RATIO = 0.9     # レイテンシ悪化時の並行数の倍率
+BREAKER_THRESHOLD = 3        # 連続失敗 (再試行を使い切った失敗を1回と数える) がこの回数に達したらそのキーのサーキットを開く
+BREAKER_COOLDOWN = 600.0     # サーキットを開いてから試行を再開 (半開) するまでの時間 (秒)
+HEDGE_QUANTILE = 0.9         # ヘッジ要求を出す待ち時間 = 観測済みレイテンシのこの分位点
+HEDGE_MIN_SAMPLES = 5        # ヘッジの待ち時間を決めるのに必要な観測数 (それまではヘッジしない)
+HEDGE_BUDGET = 0.2           # ヘッジ要求の上限 (全リクエスト数に対する比率)
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class EmptyResultError(Exception):
+    """取得結果が空だった (yfinanceはエラー時に例外ではなく空データを返すことがある)"""
+
+
+class TokenBucket:
+    """
+    全リクエストで共有するトークンバケット型レートリミッタ
+    rate 件/秒 でトークンを補充し、最大 capacity 件まで貯められる
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def is_retryable(exc):
+    """タイムアウト・429・5xx など、再試行で回復が見込めるエラーかを判定する"""
+    if isinstance(exc, (asyncio.TimeoutError, TimeoutError, ConnectionError, EmptyResultError)):
+        return True
+
+    response = getattr(exc, "response", None)
+    status = getattr(response, "status_code", None) or getattr(response, "status", None)
+    if status in RETRYABLE_STATUS:
+        return True
+
+    # yfinanceはレート制限を独自の例外 (YFRateLimitError) やメッセージで通知する
+    name = type(exc).__name__
+    message = str(exc)
+    if "RateLimit" in name or "Timeout" in name:
+        return True
+    if "Too Many Requests" in message or "Rate limited" in message:
+        return True
+    return False
+
+
+def is_throttled(exc):
+    """レート制限 (429) による失敗かを判定する"""
+    response = getattr(exc, "response", None)
+    status = getattr(response, "status_code", None) or getattr(response, "status", None)
+    if status == 429:
+        return True
+    return "RateLimit" in type(exc).__name__ or "Too Many Requests" in str(exc) or "Rate limited" in str(exc)
+
+
+def _discard_result(task):
+    """採用しなかった要求の結果を読み捨てる (例外が「取得されなかった」と警告されないようにする)"""
+    if not task.cancelled():
+        task.exception()
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_MAX):
+    """指数バックオフ + フルジッター (attemptは0始まり)"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def percentile(values, q):
+    """単純な線形補間のパーセンタイル (numpyに依存しない)"""
+    if not values:
+        return None
+    values = sorted(values)
+    pos = (len(values) - 1) * q
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return round(values[lo] + (values[hi] - values[lo]) * (pos - lo), 3)
+
+
+class ConcurrencyLimiter:
+    """
+    同時実行数の上限 (固定)。上限は実行中に変更でき、AdaptiveLimiter が結果に応じて調整する
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self._waiters = deque()
+
+    async def acquire(self):
+        while self.in_flight >= self.limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            await waiter
+        self.in_flight += 1
+
+    def release(self, latency=None, outcome="ok"):
+        """outcome: ok / error / throttled"""
+        self.in_flight -= 1
+        self.on_result(latency, outcome)
+        # 空いた枠の数だけ待機中の要求を起こす (起きた側で上限を再確認する)
+        for _ in range(max(0, self.limit - self.in_flight)):
+            if not self._waiters:
+                break
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def on_result(self, latency, outcome):
+        pass
+
+    def summary(self):
+        return {"mode": "fixed", "limit": self.limit}
+
+
+class AdaptiveLimiter(ConcurrencyLimiter):
+    """
+    AIMD (加算増加・乗算減少) で同時実行数を調整する
+    - 成功が現在の上限と同じ数だけ続いたら +1 (おおよそ1往復ごとに+1)
+    - 429 は大きく、エラー・タイムアウト・レイテンシ悪化は小さく乗算で下げる
+    レイテンシ悪化は、直近 AIMD_LATENCY_WINDOW 件の中央値と基準 (過去の区間ごとの中央値の最小値) の比で判定する
+    (どちらも中央値のため、混雑していない通常のばらつきや1回だけの遅い応答では下げない)
+    同じ混雑に対して何度も下げないよう、減少後は直近のレイテンシ程度の間は下げない
+    """
+
+    def __init__(self, initial, min_limit=1, max_limit=AIMD_MAX_CONCURRENCY,
+                 latency_tolerance=AIMD_LATENCY_TOLERANCE, window=AIMD_LATENCY_WINDOW):
+        super().__init__(initial)
+        self.initial = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self.recent = deque(maxlen=window)  # 直近の成功レイテンシ
+        self.medians = deque(maxlen=AIMD_BASELINE_WINDOWS)  # 区間ごとの成功レイテンシの中央値
+        self.samples = 0
+        self.baseline = None       # 基準レイテンシ (区間ごとの中央値の最小値)
+        self.rtt = None            # 直近レイテンシの指数移動平均
+        self.successes = 0
+        self.last_decrease = 0.0
+        self.started = time.monotonic()
+        self.history = [(0.0, initial, "start")]
+        self.decreases = {"throttled": 0, "error": 0, "latency": 0}
+
+    def _set_limit(self, limit, reason):
+        limit = max(self.min_limit, min(self.max_limit, limit))
+        if limit != self.limit:
+            self.limit = limit
+            self.history.append((round(time.monotonic() - self.started, 3), limit, reason))
+
+    def _decrease(self, ratio, reason):
+        now = time.monotonic()
+        if now - self.last_decrease < (self.rtt or 0.0):
+            return
+        self.last_decrease = now
+        self.successes = 0
+        self.decreases[reason] += 1
+        self._set_limit(int(self.limit * ratio), reason)
+
+    def on_result(self, latency, outcome):
+        if latency is not None:
+            self.rtt = latency if self.rtt is None else 0.8 * self.rtt + 0.2 * latency
+
+        if outcome == "throttled":
+            self._decrease(AIMD_THROTTLE_RATIO, "throttled")
+            return
+        if outcome != "ok":
+            self._decrease(AIMD_ERROR_RATIO, "error")
+            return
+
+        self.recent.append(latency)
+        self.samples += 1
+        if len(self.recent) == self.recent.maxlen:
+            current = percentile(list(self.recent), 0.5)
+            if self.samples % self.recent.maxlen == 0:
+                self.medians.append(current)
+                self.baseline = min(self.medians)
+            if current > self.baseline * self.latency_tolerance:
+                self._decrease(AIMD_LATENCY_RATIO, "latency")
+                return
+
+        self.successes += 1
+        if self.successes >= self.limit:
+            self.successes = 0
+            self._set_limit(self.limit + 1, "increase")
+
+    def summary(self):
+        limits = [limit for _, limit, _ in self.history]
+        return {
+            "mode": "aimd",
+            "initial": self.initial,
+            "final": self.limit,
+            "max": max(limits),
+            "min": min(limits),
+            "decreases": self.decreases,
+            "history": self.history[-100:],
+        }
+
+
+class CircuitBreakers:
+    """
+    キー (ティッカー) ごとのサーキットブレーカー
+    - closed: 通常どおり取得する
+    - open: 連続失敗が閾値に達した。クールダウンが明けるまで取得しない
+      (失敗は再試行を使い切った時点で1回と数える。再試行の1回ごとには数えない)
+    - half_open: クールダウン明け。1回だけ試し、成功なら closed、失敗なら再び open
+    path を指定すると状態をJSONに保存し、次回以降の実行にも引き継ぐ
+    """
+
+    def __init__(self, path=None, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.path = path
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.states = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.states = json.load(f)
+            except Exception as e:
+                print(f"サーキット状態の読み込みエラー: {e}")
+
+    def _get(self, key):
+        return self.states.setdefault(key, {"state": "closed", "failures": 0, "opened_at": None})
+
+    def state(self, key):
+        entry = self.states.get(key)
+        if entry is None:
+            return "closed"
+        if entry["state"] == "open" and time.time() - entry["opened_at"] >= self.cooldown:
+            entry["state"] = "half_open"
+        return entry["state"]
+
+    def allow(self, key):
+        return self.state(key) != "open"
+
+    def record_success(self, key):
+        # 正常なキーは記録しない (ファイルには失敗中のキーだけが残る)
+        self.states.pop(key, None)
+
+    def reset(self, keys):
+        """keys の状態を消して closed に戻す (--resume で取り直す銘柄など)"""
+        for key in keys:
+            self.states.pop(key, None)
+
+    def record_failure(self, key):
+        entry = self._get(key)
+        entry["failures"] += 1
+        if entry["state"] == "half_open" or entry["failures"] >= self.threshold:
+            entry["state"] = "open"
+            entry["opened_at"] = time.time()
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump(self.states, f, ensure_ascii=False, indent=2)
+        except Exception as e:
+            print(f"サーキット状態の保存エラー: {e}")
+
+
+class FetchEngine:
+    """
+    同期関数 fetch_fn(key) を並行数上限・共有レートリミッタ・再試行付きで非同期実行する
+    キーごとの試行回数とレイテンシを stats に記録する
+    """
+
+    def __init__(self, fetch_fn, concurrency=DEFAULT_CONCURRENCY, rate=DEFAULT_RATE,
+                 burst=DEFAULT_BURST, max_retries=DEFAULT_MAX_RETRIES, timeout=DEFAULT_TIMEOUT,
+                 hedge=False, adaptive=True, max_concurrency=AIMD_MAX_CONCURRENCY, breakers=None,
+                 deadline=None, hedge_fn=None, on_result=None):
+        self.fetch_fn = fetch_fn
+        # ヘッジ要求は元の要求と重複させることが目的のため、別の関数 (要求の合流を通さないもの) を指定できる
+        self.hedge_fn = hedge_fn or fetch_fn
+        # 取得に成功したキーから順に on_result(key, 結果) を呼ぶ (後段の処理を取得と重ねるため。すぐ戻ること)
+        self.on_result = on_result
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.hedge = hedge
+        self.adaptive = adaptive
+        self.max_concurrency = max_concurrency if adaptive else concurrency
+        self.limiter = None
+        self.breakers = breakers
+        self.deadline = deadline or Deadline(None)
+        self.results = {}
+        self.stats = {}
+        self.elapsed = 0.0
+        self.latencies = []
+        self.hedge_stats = {"fired": 0, "wins": 0, "saved": [], "outstanding": {}}
+
+    async def _call(self, executor, key, fn=None):
+        loop = asyncio.get_running_loop()
+        # 1リクエストのタイムアウトは実行全体の残り時間を超えない
+        return await asyncio.wait_for(
+            loop.run_in_executor(executor, fn or self.fetch_fn, key), timeout=self.deadline.timeout(self.timeout)
+        )
+
+    def hedge_delay(self):
+        """ヘッジ要求を出すまでの待ち時間 (観測数が足りない・予算切れの場合は None)"""
+        if not self.hedge or len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        requests = sum(s["attempts"] for s in self.stats.values())
+        if self.hedge_stats["fired"] >= max(1, requests * HEDGE_BUDGET):
+            return None
+        return percentile(self.latencies, HEDGE_QUANTILE)
+
+    def _on_primary_done(self, hedge_id, task):
+        """ヘッジが勝った後に元の要求が終わった時点で、短縮できた時間を確定する"""
+        _discard_result(task)
+        won_at = self.hedge_stats["outstanding"].pop(hedge_id, None)
+        if won_at is not None:
+            self.hedge_stats["saved"].append(time.monotonic() - won_at)
+
+    async def _call_hedged(self, executor, bucket, key):
+        """
+        要求が p90 レイテンシを過ぎても終わらなければ同じ要求をもう1つ出し、先に返った方を採用する
+        採用しなかった方の結果 (後から届く例外を含む) は読み捨てる
+        """
+        primary = asyncio.ensure_future(self._call(executor, key))
+        delay = self.hedge_delay()
+        if delay is None:
+            return await primary
+
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result()
+
+        await bucket.acquire()
+        self.hedge_stats["fired"] += 1
+        hedge = asyncio.ensure_future(self._call(executor, key, self.hedge_fn))
+        pending = {primary, hedge}
+
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    continue
+                if task is hedge and primary in pending:
+                    # 元の要求がまだ終わっていない場合だけヘッジの勝ちとし、元の要求の終了時に短縮時間を確定する
+                    self.hedge_stats["wins"] += 1
+                    hedge_id = id(hedge)
+                    self.hedge_stats["outstanding"][hedge_id] = time.monotonic()
+                    primary.add_done_callback(partial(self._on_primary_done, hedge_id))
+                else:
+                    for loser in pending:
+                        loser.add_done_callback(_discard_result)
+                return task.result()
+
+        # 両方失敗した場合は元の要求のエラーを返す
+        return primary.result()
+
+    async def _fetch_one(self, executor, limiter, bucket, key):
+        stat = {"status": "failed", "attempts": 0, "latency": 0.0, "attempt_latencies": [], "error": None}
+        self.stats[key] = stat
+        started = None
+
+        for attempt in range(self.max_retries + 1):
+            if self.deadline.expired():
+                stat["status"] = "deadline"
+                stat["error"] = stat["error"] or "実行期限を過ぎたため取得を打ち切りました"
+                break
+            if self.breakers and not self.breakers.allow(key):
+                # 失敗が続いている取得元を叩き続けない
+                stat["status"] = "circuit_open"
+                stat["error"] = stat["error"] or "サーキットが開いています (連続失敗のため取得を停止中)"
+                break
+            half_open = self.breakers is not None and self.breakers.state(key) == "half_open"
+
+            await bucket.acquire()
+            await limiter.acquire()
+            stat["attempts"] += 1
+            t0 = time.monotonic()
+            if started is None:
+                # レイテンシはレート制限・並行数待ちを除き、最初のリクエスト開始から測る
+                started = t0
+            try:
+                result = await self._call_hedged(executor, bucket, key)
+            except Exception as e:
+                latency = time.monotonic() - t0
+                limiter.release(latency, "throttled" if is_throttled(e) else "error")
+                stat["attempt_latencies"].append(round(latency, 3))
+                stat["error"] = f"{type(e).__name__}: {e}"
+                if not is_retryable(e) or attempt == self.max_retries or half_open:
+                    break
+            else:
+                latency = time.monotonic() - t0
+                limiter.release(latency, "ok")
+                if self.breakers:
+                    self.breakers.record_success(key)
+                self.latencies.append(latency)
+                stat["attempt_latencies"].append(round(latency, 3))
+                stat["status"] = "ok"
+                stat["error"] = None
+                stat["latency"] = round(time.monotonic() - started, 3)
+                self.results[key] = result
+                if self.on_result:
+                    self.on_result(key, result)
+                return key, result
+
+            # 並行数の枠を解放してから待つ (待機中に他のキーを進める)
+            await asyncio.sleep(self.deadline.timeout(backoff_delay(attempt)))
+
+        stat["latency"] = round(time.monotonic() - started, 3) if started is not None else 0.0
+        if self.breakers and stat["status"] == "failed":
+            # 再試行を使い切った (または再試行できない・半開の試行が失敗した) 時点で1回の失敗と数える
+            self.breakers.record_failure(key)
+        return key, None
+
+    async def run(self, keys):
+        """全キーを取得し {key: 結果} を返す (失敗したキーは含まない)"""
+        if self.adaptive:
+            limiter = AdaptiveLimiter(self.concurrency, max_limit=self.max_concurrency)
+        else:
+            limiter = ConcurrencyLimiter(self.concurrency)
+        self.limiter = limiter
+        bucket = TokenBucket(self.rate, self.burst)
+
+        # タイムアウトしたスレッドは止められないため、並行数の上限より多めに確保し、終了を待たずに解放する
+        executor = ThreadPoolExecutor(max_workers=self.max_concurrency * 2)
+        started = time.monotonic()
+        try:
+            tasks = [self._fetch_one(executor, limiter, bucket, key) for key in keys]
+            # 実行期限が来たら未完了の取得をまとめてキャンセルし、それまでの結果で先へ進む
+            await asyncio.wait_for(asyncio.gather(*tasks), timeout=self.deadline.remaining())
+        except asyncio.TimeoutError:
+            cancelled = [k for k, st in self.stats.items() if st["status"] not in ("ok", "circuit_open")]
+            for key in cancelled:
+                self.stats[key]["status"] = "deadline"
+                self.stats[key]["error"] = "実行期限を過ぎたため取得をキャンセルしました"
+            print(f"警告: 実行期限のため {len(cancelled)}銘柄の取得をキャンセルしました")
+        finally:
+            self.elapsed = time.monotonic() - started
+            executor.shutdown(wait=False, cancel_futures=True)
+            if self.breakers:
+                self.breakers.save()
+
+        return dict(self.results)
+
+    def summary(self):
+        """実行全体の統計 (成功数・失敗数・レイテンシ分布・スループット)"""
+        latencies = [s["latency"] for s in self.stats.values() if s["status"] == "ok"]
+        attempts = sum(s["attempts"] for s in self.stats.values())
+        elapsed = self.elapsed
+        return {
+            "requested": len(self.stats),
+            "ok": len(latencies),
+            "failed": sorted(k for k, s in self.stats.items() if s["status"] != "ok"),
+            "deadline": sorted(k for k, s in self.stats.items() if s["status"] == "deadline"),
+            "circuit_open": sorted(k for k, s in self.stats.items() if s["status"] == "circuit_open"),
+            "attempts": attempts,
+            "latency_p50": percentile(latencies, 0.5),
+            "latency_p90": percentile(latencies, 0.9),
+            "latency_max": max(latencies) if latencies else None,
+            "elapsed": round(elapsed, 3),
+            "requests_per_sec": round(attempts / elapsed, 2) if elapsed > 0 else None,
+            "hedge": self.hedge_summary(),
+            "concurrency": self.limiter.summary() if self.limiter else None,
+        }
+
+    def hedge_summary(self):
+        """
+        ヘッジの発動回数・勝ち数・短縮時間
+        勝った後も元の要求が終わっていないものは、集計時点までの経過時間を下限として加える
+        """
+        if not self.hedge:
+            return None
+        now = time.monotonic()
+        saved = self.hedge_stats["saved"] + [now - t for t in self.hedge_stats["outstanding"].values()]
+        return {
+            "fired": self.hedge_stats["fired"],
+            "wins": self.hedge_stats["wins"],
+            "saved_total": round(sum(saved), 3),
+            "saved_max": round(max(saved), 3) if saved else 0.0,
+            "delay": percentile(self.latencies, HEDGE_QUANTILE),
+        }
+
+
+def fetch_all(keys, fetch_fn, **kwargs):
+    """
+    同期コードから呼ぶための入口
+    戻り値: ({key: 結果}, FetchEngine) ※統計は engine.stats / engine.summary() で参照
+    """
+    engine = FetchEngine(fetch_fn, **kwargs)
+    results = asyncio.run(engine.run(list(keys)))
+    return results, engine
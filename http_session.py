@@ -0,0 +1,102 @@
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# --- 設定: 共有HTTPセッション ---
+# 接続をプールしてKeep-Aliveで使い回し、リクエストごとのTCP/TLSハンドシェイクを省く
+DEFAULT_POOL_SIZE = 10       # ホストごとに保持する接続数 (取得の同時実行数に合わせる)
+CONNECT_TIMEOUT = 5.0        # 接続確立のタイムアウト (秒)
+READ_TIMEOUT = 30.0          # 応答待ちのタイムアウト (秒)
+
+_lock = threading.Lock()
+_session = None
+_pool_size = DEFAULT_POOL_SIZE
+_local = threading.local()
+_yahoo_sessions = []  # スレッドごとに作った curl_cffi セッション (close でまとめて閉じる)
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """timeout を指定しないリクエストにも既定のタイムアウトを付けるアダプタ"""
+
+    def __init__(self, *args, timeout=None, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def configure(pool_size=DEFAULT_POOL_SIZE):
+    """
+    プールの大きさを設定する (取得の同時実行数の上限に合わせる)
+    作成済みのセッションは作り直す
+    """
+    global _session, _pool_size
+    with _lock:
+        _pool_size = max(1, int(pool_size))
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def get_session():
+    """
+    プロセス全体で共有する requests セッション (WordPress投稿など)
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = TimeoutHTTPAdapter(
+                pool_connections=_pool_size, pool_maxsize=_pool_size,
+                timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+        return _session
+
+
+def get_yahoo_session():
+    """
+    yfinance に渡すセッション
+    新しい yfinance は curl_cffi のセッションを要求するため、インストールされていればそれを使う
+    curl_cffi のセッションはスレッド間で共有できないため、スレッドごとに1つ作って使い回す
+    (各セッションが自分の接続を Keep-Alive で保持するため、接続数は取得のスレッド数 = 同時実行数に比例する。
+    configure のプールの大きさは requests セッションにだけ効く)
+    curl_cffi が無ければ共有の requests セッションを返す
+    """
+    try:
+        from curl_cffi import requests as curl_requests
+    except ImportError:
+        return get_session()
+
+    session = getattr(_local, "yahoo_session", None)
+    if session is None:
+        session = curl_requests.Session(impersonate="chrome", timeout=READ_TIMEOUT)
+        _local.yahoo_session = session
+        with _lock:
+            _yahoo_sessions.append(session)
+    return session
+
+
+def close():
+    """
+    共有セッションとスレッドごとの curl_cffi セッションを閉じる (終了前に呼ぶ)
+    通信中のスレッドが残っている場合は呼ばない (他のスレッドが使っているセッションは閉じられない)
+    """
+    global _session
+    with _lock:
+        sessions = list(_yahoo_sessions)
+        _yahoo_sessions.clear()
+        if _session is not None:
+            sessions.append(_session)
+            _session = None
+    for session in sessions:
+        try:
+            session.close()
+        except Exception:
+            pass
@@ -0,0 +1,960 @@
+import math
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:  # JITコンパイラが無い場合は NumPy の実装で計算する
+    numba = None
+
+# --- パネル計算エンジン ---
+# 全銘柄の終値・出来高を (本数 × 銘柄) の2次元配列に並べ、指標を全銘柄まとめてNumPyで計算する
+# 結果は sector_analysis.calculate_technical_indicators (銘柄ごとのpandas計算) とビット単位で一致させる
+#   - 移動平均・標準偏差は pandas の rolling と同じ逐次更新 (Kahan補正付きの加算/削除、Welford法) を
+#     行ごとに1回、全銘柄の列をまとめて進める (銘柄数が増えてもPythonのループ回数は本数のみ)
+#   - 行は日付ではなく「末尾からの本数」で揃える (銘柄ごとの欠けた足が他の銘柄の窓に混ざらないように)
+#   - 短い銘柄の先頭は NaN で埋め、present=False として扱う (NaN は pandas と同様に集計から除かれる)
+PANEL_COLUMNS = ["Open", "High", "Low", "Close", "Volume"]
+
+# --- 設定: 移動窓の計算カーネル ---
+# numba がインストールされていれば (本数 × 銘柄) の2重ループをJITコンパイルしたカーネルで計算し、
+# 無ければ NumPy で全銘柄の列をまとめて進める。どちらも pandas と同じ更新式なので結果は一致する
+# 環境変数 INDICATOR_BACKEND (numba / numpy) で固定できる
+BACKENDS = ["numba", "numpy"]
+
+
+def available_backends():
+    """この環境で使える計算カーネル"""
+    return [name for name in BACKENDS if name != "numba" or numba is not None]
+
+
+def set_backend(name):
+    """計算カーネルを切り替える (使えない名前は ValueError)"""
+    global _backend
+    if name not in available_backends():
+        raise ValueError(f"使用できない計算カーネルです: {name} (使用可能: {', '.join(available_backends())})")
+    _backend = name
+
+
+def get_backend():
+    return _backend
+
+
+_backend = os.environ.get("INDICATOR_BACKEND") or available_backends()[0]
+if _backend not in available_backends():
+    _backend = "numpy"
+
+
+def stack_frames(frames, rows=None, columns=None):
+    """
+    {キー: OHLCVデータフレーム} を末尾揃えの2次元配列に並べる
+    columns を指定した場合はその列だけを並べる (使わない列の配列を作らない)
+    戻り値: (キーのリスト, 銘柄ごとの日付インデックス, {列: 配列 (本数 × 銘柄)}, present (本数 × 銘柄))
+    """
+    keys = list(frames)
+    columns = PANEL_COLUMNS if columns is None else list(columns)
+    if rows is None:
+        rows = max((len(df) for df in frames.values()), default=0)
+    arrays = {col: np.full((rows, len(keys)), np.nan) for col in columns}
+    present = np.zeros((rows, len(keys)), dtype=bool)
+    indexes = []
+    for j, key in enumerate(keys):
+        df = frames[key].tail(rows)
+        n = len(df)
+        indexes.append(df.index)
+        present[rows - n:, j] = True
+        for col in columns:
+            if col in df.columns:
+                arrays[col][rows - n:, j] = df[col].to_numpy(dtype=float)
+    return keys, indexes, arrays, present
+
+
+def incomplete_rows(frames, keys, rows, columns):
+    """stack_frames と同じ並びで、columns のどれかが NaN の行を True にした (本数 × 銘柄) の配列"""
+    mask = np.zeros((rows, len(keys)), dtype=bool)
+    for j, key in enumerate(keys):
+        df = frames[key].tail(rows)
+        cols = [col for col in columns if col in df.columns]
+        if cols:
+            mask[rows - len(df):, j] = df[cols].isna().to_numpy().any(axis=1)
+    return mask
+
+
+def _finite(a):
+    """
+    ±inf を NaN にした配列 (pandas の rolling も計算前に inf を NaN にする。
+    そのままでは合計が inf になり、窓から外れた後も inf - inf = NaN が残り続ける)
+    """
+    a = np.asarray(a, dtype=float)
+    if np.isinf(a).any():
+        a = np.where(np.isinf(a), np.nan, a)
+    return a
+
+
+def rolling_mean(a, window):
+    """列ごとの移動平均 (選択中の計算カーネルで計算する)"""
+    a = _finite(a)
+    if _backend == "numba":
+        return _rolling_mean_jit(np.ascontiguousarray(a), window)
+    return _rolling_mean_numpy(a, window)
+
+
+def rolling_std(a, window, ddof=1):
+    """列ごとの移動標準偏差 (選択中の計算カーネルで計算する)"""
+    a = _finite(a)
+    if _backend == "numba":
+        return _rolling_std_jit(np.ascontiguousarray(a), window, ddof)
+    return _rolling_std_numpy(a, window, ddof)
+
+
+def _rolling_mean_numpy(a, window):
+    """
+    列ごとの移動平均 (pandas の Series.rolling(window).mean() と同じ計算順序)
+    窓内の有効値が window 本に満たない行は NaN
+    """
+    rows, cols = a.shape
+    out = np.full(a.shape, np.nan)
+    total = np.zeros(cols)
+    comp_add = np.zeros(cols)
+    comp_remove = np.zeros(cols)
+    nobs = np.zeros(cols)
+    neg_ct = np.zeros(cols)
+    same_ct = np.zeros(cols)
+    prev = a[0].copy() if rows else np.zeros(cols)
+
+    for i in range(rows):
+        if i >= window:
+            val = a[i - window]
+            valid = ~np.isnan(val)
+            y = -val - comp_remove
+            t = total + y
+            comp_remove = np.where(valid, t - total - y, comp_remove)
+            total = np.where(valid, t, total)
+            nobs -= valid
+            neg_ct -= valid & np.signbit(val)
+
+        val = a[i]
+        valid = ~np.isnan(val)
+        y = val - comp_add
+        t = total + y
+        comp_add = np.where(valid, t - total - y, comp_add)
+        total = np.where(valid, t, total)
+        nobs += valid
+        neg_ct += valid & np.signbit(val)
+        same_ct = np.where(valid, np.where(val == prev, same_ct + 1, 1), same_ct)
+        prev = np.where(valid, val, prev)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            result = total / nobs
+        # 窓内が同じ値の連続なら誤差を除くためその値、符号がそろっているのに逆符号になった場合は 0
+        result = np.where(same_ct >= nobs, prev, result)
+        result = np.where((same_ct < nobs) & (neg_ct == 0) & (result < 0), 0.0, result)
+        result = np.where((same_ct < nobs) & (neg_ct == nobs) & (result > 0), 0.0, result)
+        out[i] = np.where((nobs >= window) & (nobs > 0), result, np.nan)
+    return out
+
+
+def _rolling_std_numpy(a, window, ddof=1):
+    """
+    列ごとの移動標準偏差 (pandas の Series.rolling(window).std() と同じ Welford法 + Kahan補正)
+    """
+    rows, cols = a.shape
+    out = np.full(a.shape, np.nan)
+    mean = np.zeros(cols)
+    ssqdm = np.zeros(cols)
+    comp_add = np.zeros(cols)
+    comp_remove = np.zeros(cols)
+    nobs = np.zeros(cols)
+    same_ct = np.zeros(cols)
+    prev = a[0].copy() if rows else np.zeros(cols)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for i in range(rows):
+            if i >= window:
+                val = a[i - window]
+                valid = ~np.isnan(val)
+                nobs -= valid
+                prev_mean = mean - comp_remove
+                y = val - comp_remove
+                t = y - mean
+                new_comp = t + mean - y
+                new_mean = mean - t / nobs
+                new_ssqdm = ssqdm - (val - prev_mean) * (val - new_mean)
+                emptied = valid & (nobs == 0)
+                update = valid & (nobs > 0)
+                comp_remove = np.where(update, new_comp, comp_remove)
+                mean = np.where(update, new_mean, np.where(emptied, 0.0, mean))
+                ssqdm = np.where(update, new_ssqdm, np.where(emptied, 0.0, ssqdm))
+
+            val = a[i]
+            valid = ~np.isnan(val)
+            nobs += valid
+            same_ct = np.where(valid, np.where(val == prev, same_ct + 1, 1), same_ct)
+            prev = np.where(valid, val, prev)
+            prev_mean = mean - comp_add
+            y = val - comp_add
+            t = y - mean
+            new_comp = t + mean - y
+            new_mean = np.where(nobs > 0, mean + t / nobs, 0.0)
+            new_ssqdm = ssqdm + (val - prev_mean) * (val - new_mean)
+            comp_add = np.where(valid, new_comp, comp_add)
+            mean = np.where(valid, new_mean, mean)
+            ssqdm = np.where(valid, new_ssqdm, ssqdm)
+
+            var = np.where((nobs == 1) | (same_ct >= nobs), 0.0, ssqdm / (nobs - ddof))
+            var = np.where((nobs >= window) & (nobs > ddof), var, np.nan)
+            out[i] = np.sqrt(np.where(var < 0, 0.0, var))
+    return out
+
+
+# --- JITカーネル ---
+# 上の NumPy 版と同じ更新を1銘柄・1本ずつのスカラー演算で行う (numba でコンパイルして使う)
+# 行ごとに全銘柄の状態を進めるので、配列は行方向に連続したまま読み書きする
+
+
+def _rolling_mean_kernel(a, window):
+    rows, cols = a.shape
+    out = np.empty((rows, cols))
+    total = np.zeros(cols)
+    comp_add = np.zeros(cols)
+    comp_remove = np.zeros(cols)
+    nobs = np.zeros(cols, dtype=np.int64)
+    neg_ct = np.zeros(cols, dtype=np.int64)
+    same_ct = np.zeros(cols, dtype=np.int64)
+    prev = np.zeros(cols)
+    if rows:
+        prev[:] = a[0]
+
+    for i in range(rows):
+        for j in range(cols):
+            if i >= window:
+                val = a[i - window, j]
+                if not math.isnan(val):
+                    y = -val - comp_remove[j]
+                    t = total[j] + y
+                    comp_remove[j] = t - total[j] - y
+                    total[j] = t
+                    nobs[j] -= 1
+                    if math.copysign(1.0, val) < 0:
+                        neg_ct[j] -= 1
+
+            val = a[i, j]
+            if not math.isnan(val):
+                y = val - comp_add[j]
+                t = total[j] + y
+                comp_add[j] = t - total[j] - y
+                total[j] = t
+                nobs[j] += 1
+                if math.copysign(1.0, val) < 0:
+                    neg_ct[j] += 1
+                same_ct[j] = same_ct[j] + 1 if val == prev[j] else 1
+                prev[j] = val
+
+            n = nobs[j]
+            if n >= window and n > 0:
+                if same_ct[j] >= n:
+                    result = prev[j]
+                else:
+                    result = total[j] / n
+                    if neg_ct[j] == 0 and result < 0:
+                        result = 0.0
+                    elif neg_ct[j] == n and result > 0:
+                        result = 0.0
+                out[i, j] = result
+            else:
+                out[i, j] = np.nan
+    return out
+
+
+def _rolling_std_kernel(a, window, ddof):
+    rows, cols = a.shape
+    out = np.empty((rows, cols))
+    mean = np.zeros(cols)
+    ssqdm = np.zeros(cols)
+    comp_add = np.zeros(cols)
+    comp_remove = np.zeros(cols)
+    nobs = np.zeros(cols, dtype=np.int64)
+    same_ct = np.zeros(cols, dtype=np.int64)
+    prev = np.zeros(cols)
+    if rows:
+        prev[:] = a[0]
+
+    for i in range(rows):
+        for j in range(cols):
+            if i >= window:
+                val = a[i - window, j]
+                if not math.isnan(val):
+                    nobs[j] -= 1
+                    if nobs[j] > 0:
+                        prev_mean = mean[j] - comp_remove[j]
+                        y = val - comp_remove[j]
+                        t = y - mean[j]
+                        comp_remove[j] = t + mean[j] - y
+                        mean[j] = mean[j] - t / nobs[j]
+                        ssqdm[j] = ssqdm[j] - (val - prev_mean) * (val - mean[j])
+                    else:
+                        mean[j] = 0.0
+                        ssqdm[j] = 0.0
+
+            val = a[i, j]
+            if not math.isnan(val):
+                nobs[j] += 1
+                same_ct[j] = same_ct[j] + 1 if val == prev[j] else 1
+                prev[j] = val
+                prev_mean = mean[j] - comp_add[j]
+                y = val - comp_add[j]
+                t = y - mean[j]
+                comp_add[j] = t + mean[j] - y
+                mean[j] = mean[j] + t / nobs[j]
+                ssqdm[j] = ssqdm[j] + (val - prev_mean) * (val - mean[j])
+
+            n = nobs[j]
+            if n >= window and n > ddof:
+                if n == 1 or same_ct[j] >= n:
+                    var = 0.0
+                else:
+                    var = ssqdm[j] / (n - ddof)
+                out[i, j] = math.sqrt(0.0 if var < 0 else var)
+            else:
+                out[i, j] = np.nan
+    return out
+
+
+if numba is not None:
+    _rolling_mean_jit = numba.njit(cache=True, nogil=True)(_rolling_mean_kernel)
+    _rolling_std_jit = numba.njit(cache=True, nogil=True)(_rolling_std_kernel)
+
+
+def shift(a, periods=1):
+    out = np.full(a.shape, np.nan)
+    out[periods:] = a[:-periods]
+    return out
+
+
+def forward_fill(a):
+    """列ごとに直前の値で NaN を埋める (pct_change と同じ扱い。先頭の埋め草は NaN のまま)"""
+    idx = np.where(~np.isnan(a), np.arange(len(a))[:, None], 0)
+    np.maximum.accumulate(idx, axis=0, out=idx)
+    return a[idx, np.arange(a.shape[1])]
+
+
+# --- 逐次計算 (ストリーミング) ---
+# 銘柄ごとに移動窓の状態 (窓内の値・Kahan補正付きの合計・Welford法の平均と偏差平方和) を保持し、
+# 新しい足1本を O(1) で追加する。状態はJSONにして実行間で引き継ぐ
+# 更新式は rolling_mean / rolling_std (= pandas) と同じなので、同じ足から積み上げれば結果はビット単位で一致する
+
+
+class RollingMean:
+    """1列分の移動平均の状態 (pandas の roll_mean と同じ更新)"""
+
+    def __init__(self, window, state=None):
+        self.window = window
+        state = state or {}
+        self.values = deque(state.get("values", []))
+        self.total = state.get("total", 0.0)
+        self.comp_add = state.get("comp_add", 0.0)
+        self.comp_remove = state.get("comp_remove", 0.0)
+        self.nobs = state.get("nobs", 0)
+        self.neg_ct = state.get("neg_ct", 0)
+        self.same_ct = state.get("same_ct", 0)
+        self.prev = state.get("prev", math.nan)
+
+    def push(self, val):
+        """値を1つ追加し (窓から外れた値は削除し)、移動平均を返す"""
+        if math.isinf(val):
+            val = math.nan  # rolling_mean / rolling_std と同じく inf は欠損として扱う
+        if len(self.values) == self.window:
+            old = self.values.popleft()
+            if old == old:
+                y = -old - self.comp_remove
+                t = self.total + y
+                self.comp_remove = t - self.total - y
+                self.total = t
+                self.nobs -= 1
+                if math.copysign(1.0, old) < 0:
+                    self.neg_ct -= 1
+        self.values.append(val)
+
+        if val == val:
+            y = val - self.comp_add
+            t = self.total + y
+            self.comp_add = t - self.total - y
+            self.total = t
+            self.nobs += 1
+            if math.copysign(1.0, val) < 0:
+                self.neg_ct += 1
+            self.same_ct = self.same_ct + 1 if val == self.prev else 1
+            self.prev = val
+
+        if self.nobs < self.window or self.nobs == 0:
+            return math.nan
+        if self.same_ct >= self.nobs:
+            return self.prev
+        result = self.total / self.nobs
+        if self.neg_ct == 0 and result < 0:
+            return 0.0
+        if self.neg_ct == self.nobs and result > 0:
+            return 0.0
+        return result
+
+    def to_dict(self):
+        return {
+            "values": list(self.values), "total": self.total, "comp_add": self.comp_add,
+            "comp_remove": self.comp_remove, "nobs": self.nobs, "neg_ct": self.neg_ct,
+            "same_ct": self.same_ct, "prev": self.prev,
+        }
+
+
+class RollingStd:
+    """1列分の移動標準偏差の状態 (pandas の roll_var と同じ Welford法の更新)"""
+
+    def __init__(self, window, state=None, ddof=1):
+        self.window = window
+        self.ddof = ddof
+        state = state or {}
+        self.values = deque(state.get("values", []))
+        self.mean = state.get("mean", 0.0)
+        self.ssqdm = state.get("ssqdm", 0.0)
+        self.comp_add = state.get("comp_add", 0.0)
+        self.comp_remove = state.get("comp_remove", 0.0)
+        self.nobs = state.get("nobs", 0)
+        self.same_ct = state.get("same_ct", 0)
+        self.prev = state.get("prev", math.nan)
+
+    def push(self, val):
+        """値を1つ追加し (窓から外れた値は削除し)、移動標準偏差を返す"""
+        if math.isinf(val):
+            val = math.nan  # rolling_mean / rolling_std と同じく inf は欠損として扱う
+        if len(self.values) == self.window:
+            old = self.values.popleft()
+            if old == old:
+                self.nobs -= 1
+                if self.nobs:
+                    prev_mean = self.mean - self.comp_remove
+                    y = old - self.comp_remove
+                    t = y - self.mean
+                    self.comp_remove = t + self.mean - y
+                    self.mean = self.mean - t / self.nobs
+                    self.ssqdm = self.ssqdm - (old - prev_mean) * (old - self.mean)
+                else:
+                    self.mean = 0.0
+                    self.ssqdm = 0.0
+        self.values.append(val)
+
+        if val == val:
+            self.nobs += 1
+            self.same_ct = self.same_ct + 1 if val == self.prev else 1
+            self.prev = val
+            prev_mean = self.mean - self.comp_add
+            y = val - self.comp_add
+            t = y - self.mean
+            self.comp_add = t + self.mean - y
+            self.mean = self.mean + t / self.nobs
+            self.ssqdm = self.ssqdm + (val - prev_mean) * (val - self.mean)
+
+        if self.nobs < self.window or self.nobs <= self.ddof:
+            return math.nan
+        if self.nobs == 1 or self.same_ct >= self.nobs:
+            return 0.0
+        var = self.ssqdm / (self.nobs - self.ddof)
+        return math.sqrt(var) if var > 0 else 0.0
+
+    def to_dict(self):
+        return {
+            "values": list(self.values), "mean": self.mean, "ssqdm": self.ssqdm,
+            "comp_add": self.comp_add, "comp_remove": self.comp_remove, "nobs": self.nobs,
+            "same_ct": self.same_ct, "prev": self.prev,
+        }
+
+
+def _divide(a, b):
+    """NumPy と同じく 0 除算を inf / NaN にする割り算"""
+    try:
+        return a / b
+    except ZeroDivisionError:
+        if a != a or a == 0:
+            return math.nan
+        return math.copysign(math.inf, a) * math.copysign(1.0, b)
+
+
+# --- 指標の定義 (レジストリ) ---
+# 各ノードは「演算・入力ノード・パラメータ」で定義し、同じ定義のノード (同じ列・同じ期間の移動平均など) は1つにまとめる
+# 演算ごとにパネル計算 (2次元配列) と逐次計算 (1本ずつ) の両方を持ち、どちらも同じグラフから計算する
+
+
+class Op:
+    """
+    演算の定義
+    panel(入力配列..., present=, **params) → 配列
+    stream(state, 入力値..., **params) → 値 (state は new_state() が返す、JSONにできる辞書または移動窓)
+    """
+
+    name = None
+
+    def lookback(self, input_lookbacks, **params):
+        """最初の値を出すまでに必要な本数 (当日を含む)"""
+        return max(input_lookbacks)
+
+    def new_state(self, state=None, **params):
+        return None
+
+    def panel(self, *inputs, present=None, **params):
+        raise NotImplementedError
+
+    def stream(self, state, *inputs, **params):
+        raise NotImplementedError
+
+
+class MeanOp(Op):
+    name = "mean"
+
+    def lookback(self, input_lookbacks, window):
+        return max(input_lookbacks) + window - 1
+
+    def new_state(self, state=None, window=None):
+        return RollingMean(window, state)
+
+    def panel(self, a, present=None, window=None):
+        return rolling_mean(a, window)
+
+    def stream(self, state, a, window=None):
+        return state.push(a)
+
+
+class StdOp(MeanOp):
+    name = "std"
+
+    def new_state(self, state=None, window=None):
+        return RollingStd(window, state)
+
+    def panel(self, a, present=None, window=None):
+        return rolling_std(a, window)
+
+
+class DeltaOp(Op):
+    """前の足との差 (diff)"""
+    name = "delta"
+
+    def lookback(self, input_lookbacks):
+        return max(input_lookbacks) + 1
+
+    def new_state(self, state=None):
+        return dict(state or {"last": math.nan})
+
+    def panel(self, a, present=None):
+        return a - shift(a)
+
+    def stream(self, state, a):
+        delta = a - state["last"]
+        state["last"] = a
+        return delta
+
+
+class GainOp(Op):
+    """上昇幅 (差分が無い・下落した足は 0。pandas の where と同じ)"""
+    name = "gain"
+
+    def panel(self, delta, present=None):
+        return np.where(present, np.where(delta > 0, delta, 0.0), np.nan)
+
+    def stream(self, state, delta):
+        return delta if delta > 0 else 0.0
+
+
+class LossOp(Op):
+    """下落幅 (符号を反転。差分が無い・上昇した足は -0.0)"""
+    name = "loss"
+
+    def panel(self, delta, present=None):
+        return np.where(present, -np.where(delta < 0, delta, 0.0), np.nan)
+
+    def stream(self, state, delta):
+        return -(delta if delta < 0 else 0.0)
+
+
+class DeviationOp(Op):
+    """移動平均乖離率 (%)"""
+    name = "deviation"
+
+    def panel(self, a, ma, present=None):
+        return ((a - ma) / ma) * 100
+
+    def stream(self, state, a, ma):
+        return _divide(a - ma, ma) * 100
+
+
+class RsiOp(Op):
+    name = "rsi"
+
+    def panel(self, gain, loss, present=None):
+        return 100 - (100 / (1 + gain / loss))
+
+    def stream(self, state, gain, loss):
+        return 100 - _divide(100, 1 + _divide(gain, loss))
+
+
+class PercentBOp(Op):
+    """ボリンジャーバンド %B"""
+    name = "pct_b"
+
+    def panel(self, a, ma, std, present=None, sigma=None):
+        up = ma + (std * sigma)
+        low = ma - (std * sigma)
+        width = up - low
+        return np.where(width == 0, 0, (a - low) / width)
+
+    def stream(self, state, a, ma, std, sigma=None):
+        up = ma + (std * sigma)
+        low = ma - (std * sigma)
+        width = up - low
+        return 0.0 if width == 0 else _divide(a - low, width)
+
+
+class RatioOp(Op):
+    """平均に対する倍率 (平均が 0 なら 0)"""
+    name = "ratio"
+
+    def panel(self, a, ma, present=None):
+        return np.where(ma == 0, 0, a / ma)
+
+    def stream(self, state, a, ma):
+        return 0.0 if ma == 0 else _divide(a, ma)
+
+
+class ChangeOp(Op):
+    """前日比 (%)。欠けた値は直前の値で埋めてから比べる (pct_change と同じ)"""
+    name = "change"
+
+    def lookback(self, input_lookbacks):
+        return max(input_lookbacks) + 1
+
+    def new_state(self, state=None):
+        return dict(state or {"last": math.nan})
+
+    def panel(self, a, present=None):
+        filled = forward_fill(a)
+        return (filled / shift(filled) - 1) * 100
+
+    def stream(self, state, a):
+        filled = a if a == a else state["last"]
+        change = (_divide(filled, state["last"]) - 1) * 100
+        state["last"] = filled
+        return change
+
+
+OPS = {op.name: op for op in [
+    MeanOp(), StdOp(), DeltaOp(), GainOp(), LossOp(), DeviationOp(), RsiOp(), PercentBOp(), RatioOp(),
+    ChangeOp(),
+]}
+
+
+class IndicatorGraph:
+    """
+    指標の依存グラフ
+    node() で中間ノードを定義し (同じ定義は同じノードを返す)、output() で指標名を付ける
+    計算時は要求された指標に必要なノードだけを依存順に1回ずつ計算する
+    """
+
+    def __init__(self, base=("Open", "High", "Low", "Close", "Volume")):
+        self.base = list(base)
+        self.nodes = {}
+        self.outputs = {}
+
+    def node(self, op, *inputs, **params):
+        """ノードを定義してキーを返す。入力は基本列名 (Close など) か他のノードのキー"""
+        for key in inputs:
+            if key not in self.base and key not in self.nodes:
+                raise KeyError(f"未定義の入力です: {key}")
+        args = ",".join(list(inputs) + [f"{k}={v}" for k, v in sorted(params.items())])
+        key = f"{op}({args})"
+        if key not in self.nodes:
+            self.nodes[key] = (OPS[op], list(inputs), params)
+        return key
+
+    def output(self, name, key):
+        self.outputs[name] = key
+
+    def plan(self, names=None):
+        """要求された指標に必要なノードを依存順に並べる (共有ノードは1回だけ)"""
+        order, seen = [], set()
+
+        def visit(key):
+            if key in seen or key in self.base:
+                return
+            seen.add(key)
+            for dep in self.nodes[key][1]:
+                visit(dep)
+            order.append(key)
+
+        for name in (self.outputs if names is None else names):
+            visit(self.outputs[name])
+        return order
+
+    def lookback(self, names=None):
+        """要求された指標のうち、最初の値を出すまでに最も多く必要な本数 (当日を含む)"""
+        bars = {key: 1 for key in self.base}
+        for key in self.plan(names):
+            op, inputs, params = self.nodes[key]
+            bars[key] = op.lookback([bars[dep] for dep in inputs], **params)
+        return max((bars[self.outputs[name]] for name in (self.outputs if names is None else names)),
+                   default=1)
+
+    def inputs(self, names=None):
+        """要求された指標の計算に使う基本列 (Close など)"""
+        used = {dep for key in self.plan(names) for dep in self.nodes[key][1]}
+        return [key for key in self.base if key in used]
+
+    def signature(self):
+        """グラフの定義 (逐次計算の状態に保存し、定義が変わったら状態を作り直す)"""
+        return sorted(self.nodes) + [f"{name}={key}" for name, key in sorted(self.outputs.items())]
+
+    def compute_panel(self, base, present, names=None, dtype=None):
+        """
+        base: {基本列名: 配列 (本数 × 銘柄)}。要求された指標を {指標名: 配列} で返す
+        中間ノードは最後の利用先を計算した時点で解放する。dtype を指定すると指標をその型で返す
+        """
+        names = list(self.outputs if names is None else names)
+        order = self.plan(names)
+        keep = {self.outputs[name] for name in names}
+        consumers = {}
+        for key in order:
+            for dep in self.nodes[key][1]:
+                consumers[dep] = consumers.get(dep, 0) + 1
+
+        values = {}
+
+        def release(key):
+            # 使い終わったノード: 中間値は捨て、指標は dtype に変換する
+            if key not in values:
+                return
+            if key not in keep:
+                del values[key]
+            elif dtype is not None:
+                values[key] = values[key].astype(dtype, copy=False)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for key in order:
+                op, inputs, params = self.nodes[key]
+                values[key] = op.panel(*[values[dep] if dep in values else base[dep] for dep in inputs],
+                                       present=present, **params)
+                if not consumers.get(key):
+                    release(key)
+                for dep in inputs:
+                    consumers[dep] -= 1
+                    if consumers[dep] == 0:
+                        release(dep)
+        return {name: values[self.outputs[name]] for name in names}
+
+    def compute_latest(self, base, present, names=None):
+        """
+        最後の足の指標だけを計算する。各銘柄の末尾 lookback 本 (最も長い窓の分) だけを使うため、
+        計算量は履歴の長さではなく窓の長さに比例する
+        戻り値: {指標名: 1次元配列 (銘柄)}
+        """
+        rows = self.lookback(names)
+        window = {key: array[-rows:] for key, array in base.items()}
+        values = self.compute_panel(window, present[-rows:], names)
+        return {name: array[-1] for name, array in values.items()}
+
+    def stream(self, state=None, names=None):
+        return GraphStream(self, state, names)
+
+
+class GraphStream:
+    """
+    1銘柄分の逐次計算の状態 (グラフのノードごとの移動窓など)
+    push() に足を1本ずつ渡すと、その足の指標を返す
+    """
+
+    def __init__(self, graph, state=None, names=None):
+        self.graph = graph
+        self.names = list(graph.outputs if names is None else names)
+        self.order = graph.plan(self.names)
+        state = state or {}
+        saved = state.get("nodes", {})
+        self.states = {}
+        for key in self.order:
+            op, _, params = graph.nodes[key]
+            self.states[key] = op.new_state(saved.get(key), **params)
+        self.last_date = state.get("last_date")
+        self.bars = state.get("bars", 0)
+
+    def push(self, date, bar):
+        """bar: 基本列の値 {'Open', ..., 'Volume'}。戻り値: 基本列と指標名 → 値"""
+        values = dict(bar)
+        for key in self.order:
+            op, inputs, params = self.graph.nodes[key]
+            values[key] = op.stream(self.states[key], *[values[dep] for dep in inputs], **params)
+        self.last_date = date
+        self.bars += 1
+        out = dict(bar)
+        out.update({name: values[self.graph.outputs[name]] for name in self.names})
+        return out
+
+    def recent(self):
+        """
+        状態に含まれる直近の基本列の値 (保存済みデータの修正を検出するために使う)
+        基本列ごとに、最も長い移動窓が保持している値を返す
+        """
+        recent = {}
+        for key in self.order:
+            state = self.states[key]
+            source = self.graph.nodes[key][1][0]
+            if isinstance(state, (RollingMean, RollingStd)) and source in self.graph.base:
+                if len(state.values) > len(recent.get(source, [])):
+                    recent[source] = list(state.values)
+        return recent
+
+    def to_dict(self):
+        nodes = {}
+        for key, state in self.states.items():
+            if isinstance(state, (RollingMean, RollingStd)):
+                nodes[key] = state.to_dict()
+            elif state is not None:
+                nodes[key] = state
+        return {
+            "graph": self.graph.signature(), "last_date": self.last_date, "bars": self.bars,
+            "nodes": nodes,
+        }
+
+
+def build_graph(ma_windows, rsi_window, bb_window, bb_sigma, volume_window):
+    """
+    出力する指標のグラフ (sector_analysis.calculate_technical_indicators と同じ指標)
+    指標を足す場合はここにノードと出力を追加する (取得期間は lookback() から自動で決まる)
+    """
+    graph = IndicatorGraph()
+
+    # 1. 移動平均乖離率
+    for column, window in ma_windows.items():
+        graph.output(column, graph.node("deviation", "Close", graph.node("mean", "Close", window=window)))
+
+    # 2. RSI
+    delta = graph.node("delta", "Close")
+    graph.output("rsi", graph.node(
+        "rsi",
+        graph.node("mean", graph.node("gain", delta), window=rsi_window),
+        graph.node("mean", graph.node("loss", delta), window=rsi_window),
+    ))
+
+    # 3. ボリンジャーバンド %B (移動平均は同じ期間の移動平均乖離率と共有される)
+    graph.output("bb_pct_b", graph.node(
+        "pct_b", "Close", graph.node("mean", "Close", window=bb_window),
+        graph.node("std", "Close", window=bb_window), sigma=bb_sigma,
+    ))
+
+    # 4. 出来高倍率
+    graph.output("vol_ratio", graph.node("ratio", "Volume", graph.node("mean", "Volume", window=volume_window)))
+
+    # 5. 前日比
+    graph.output("change_pct", graph.node("change", "Close"))
+    return graph
+
+
+# --- プロセス並列 ---
+# 銘柄 (列) を範囲に分けてプロセスプールで計算する。列どうしは独立なので結果は1プロセスの計算と同じ
+# 入力 (終値・出来高など) と出力の配列は共有メモリに置き、子プロセスには名前と形だけを渡す
+# (配列をpickleで送らず、子プロセスは入力をコピーせずに読み、出力を親が確保した領域に直接書く)
+PARALLEL_MIN_COLUMNS = 64    # これより銘柄が少なければプロセスを使わずに計算する
+# 子プロセスの起動方法。取得・投稿のスレッドが動いている親を fork すると、ロックを握ったまま複製される
+# おそれがあるため、fork せずに新しいプロセスから起動する (forkserver が無い環境では spawn)
+PARALLEL_START_METHOD = "forkserver"
+
+
+def _create_shared(shape, dtype):
+    dtype = np.dtype(dtype)
+    size = max(1, int(np.prod(shape)) * dtype.itemsize)
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _attach_shared(spec):
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+def _parallel_context():
+    """プロセスプールの起動方法 (使えない環境では spawn)"""
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context(PARALLEL_START_METHOD if PARALLEL_START_METHOD in methods else "spawn")
+
+
+def _panel_worker(graph, names, inputs, present, outputs, lo, hi, backend):
+    """子プロセス: 列 lo:hi を計算して共有メモリの出力に書く (計算カーネルは親と同じものを使う)"""
+    set_backend(backend)
+    handles = []
+    base, mask, values, array = {}, None, None, None
+    try:
+        for key, spec in inputs.items():
+            shm, array = _attach_shared(spec)
+            handles.append(shm)
+            base[key] = array[:, lo:hi]
+        shm, mask = _attach_shared(present)
+        handles.append(shm)
+        values = graph.compute_panel(base, mask[:, lo:hi], names)
+        for name, spec in outputs.items():
+            shm, array = _attach_shared(spec)
+            handles.append(shm)
+            array[:, lo:hi] = values[name]
+        return hi - lo
+    finally:
+        # 配列の参照を外してから閉じる (解放は親が行う)
+        base = mask = values = array = None
+        for shm in handles:
+            shm.close()
+
+
+def compute_panel_parallel(graph, base, present, names=None, workers=None, dtype=None):
+    """
+    graph.compute_panel を銘柄の範囲ごとにプロセスプールで計算する (workers = プロセス数、既定はCPUコア数)
+    銘柄が少ない・1プロセスの場合はそのまま計算する
+    """
+    names = list(graph.outputs if names is None else names)
+    workers = workers or os.cpu_count() or 1
+    cols = present.shape[1]
+    if workers <= 1 or cols < PARALLEL_MIN_COLUMNS:
+        return graph.compute_panel(base, present, names, dtype=dtype)
+
+    handles = []
+    array = mask = views = None
+    try:
+        inputs = {}
+        for key in graph.inputs(names):
+            shm, array = _create_shared(base[key].shape, np.float64)
+            array[:] = base[key]
+            handles.append(shm)
+            inputs[key] = (shm.name, array.shape, "float64")
+        shm, mask = _create_shared(present.shape, bool)
+        mask[:] = present
+        handles.append(shm)
+        present_spec = (shm.name, present.shape, "bool")
+        out_dtype = np.dtype(dtype or np.float64)
+        outputs, views = {}, {}
+        for name in names:
+            shm, views[name] = _create_shared(present.shape, out_dtype)
+            handles.append(shm)
+            outputs[name] = (shm.name, present.shape, out_dtype.str)
+
+        bounds = np.linspace(0, cols, min(workers, cols) + 1).astype(int)
+        with ProcessPoolExecutor(max_workers=len(bounds) - 1, mp_context=_parallel_context()) as executor:
+            futures = [
+                executor.submit(_panel_worker, graph, names, inputs, present_spec, outputs, int(lo), int(hi),
+                                _backend)
+                for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo
+            ]
+            for future in futures:
+                future.result()
+        # 共有メモリは解放するため、結果は通常の配列に移す
+        return {name: np.array(view) for name, view in views.items()}
+    finally:
+        array = mask = views = None
+        for shm in handles:
+            shm.close()
+            shm.unlink()
+
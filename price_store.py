@@ -0,0 +1,125 @@
+import json
+import os
+import threading
+import pandas as pd
+
+# --- 設定: ローカル株価ストア ---
+# ティッカーごとに1ファイル (日付 × OHLCV) のCSVとして保存する
+PRICE_STORE_DIR = os.environ.get("PRICE_STORE_DIR", "price_store")
+OHLCV_COLUMNS = ["Open", "High", "Low", "Close", "Volume"]
+
+
+def normalize_ohlcv(df):
+    """
+    yfinance等から取得したデータフレームをストア形式 (tzなし日付インデックス × OHLCV) に揃える
+    """
+    if df is None or df.empty:
+        return pd.DataFrame(columns=OHLCV_COLUMNS, index=pd.DatetimeIndex([], name="Date"))
+
+    df = df[[c for c in OHLCV_COLUMNS if c in df.columns]].copy()
+    index = pd.DatetimeIndex(df.index)
+    if index.tz is not None:
+        index = index.tz_localize(None)
+    df.index = index.normalize().rename("Date")
+
+    # 同一日付が重複した場合は後から来た行を優先
+    df = df[~df.index.duplicated(keep="last")].sort_index()
+    return df
+
+
+def store_path(ticker, store_dir=None):
+    """ティッカーに対応するストアファイルのパス"""
+    return os.path.join(store_dir or PRICE_STORE_DIR, f"{ticker}.csv")
+
+
+def fetched_from_path(ticker, store_dir=None):
+    """全期間取得で要求した開始日の記録ファイルのパス"""
+    return os.path.join(store_dir or PRICE_STORE_DIR, f"{ticker}.json")
+
+
+def load_fetched_from(ticker, store_dir=None):
+    """
+    ストアを作った全期間取得で要求した開始日 (記録が無ければ None)
+    取得元にその日以降の足しか無い (上場が新しいなど) ため本数が少ないストアを、取り直し不要と判断するのに使う
+    """
+    try:
+        with open(fetched_from_path(ticker, store_dir), 'r', encoding='utf-8') as f:
+            return pd.Timestamp(json.load(f)["fetched_from"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def load_prices(ticker, store_dir=None):
+    """
+    保存済みのOHLCVを読み込む。未保存の場合は None を返す
+    """
+    path = store_path(ticker, store_dir)
+    if not os.path.exists(path):
+        return None
+
+    try:
+        df = pd.read_csv(path, index_col="Date", parse_dates=["Date"])
+    except Exception as e:
+        # 壊れたファイルは無視して全期間を取り直す
+        print(f"ストア読み込みエラー {ticker}: {e}")
+        return None
+
+    if df.empty:
+        return None
+    return normalize_ohlcv(df)
+
+
+def save_prices(ticker, df, store_dir=None, fetched_from=None):
+    """
+    OHLCVをストアへ書き込む (一時ファイル経由で置き換え、書き込み途中の破損を防ぐ)
+    fetched_from を指定した場合 (全期間取得の結果を保存する場合) は、要求した開始日も記録する
+    """
+    path = store_path(ticker, store_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # 同じティッカーを並行して書く場合 (ヘッジ要求など) に一時ファイルが衝突しないようにする
+    suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+    normalize_ohlcv(df).to_csv(path + suffix, date_format="%Y-%m-%d")
+    os.replace(path + suffix, path)
+
+    if fetched_from is not None:
+        marker = fetched_from_path(ticker, store_dir)
+        with open(marker + suffix, 'w', encoding='utf-8') as f:
+            json.dump({"fetched_from": pd.Timestamp(fetched_from).strftime('%Y-%m-%d')}, f)
+        os.replace(marker + suffix, marker)
+
+
+def is_restated(stored, fetched, rtol=1e-6):
+    """
+    重複期間 (オーバーラップ) の終値・出来高を比較し、過去データが修正されたかを判定する
+    配当・分割による調整後終値の変更を検出するために使う
+    """
+    common = stored.index.intersection(fetched.index)
+    if len(common) == 0:
+        # 重複がない = 連続性を確認できないので修正ありとみなす
+        return True
+
+    for col in ["Close", "Volume"]:
+        if col not in stored.columns or col not in fetched.columns:
+            continue
+        old = stored.loc[common, col].astype(float)
+        new = fetched.loc[common, col].astype(float)
+        diff = (old - new).abs()
+        tolerance = new.abs() * rtol + 1e-9
+        if (diff > tolerance).any():
+            return True
+    return False
+
+
+def merge_prices(stored, fetched):
+    """
+    保存済みデータに新規取得分をマージする (重複日付は新規取得分で上書き)
+    """
+    if stored is None or stored.empty:
+        return normalize_ohlcv(fetched)
+    if fetched is None or fetched.empty:
+        return stored
+
+    merged = pd.concat([stored, normalize_ohlcv(fetched)])
+    merged = merged[~merged.index.duplicated(keep="last")].sort_index()
+    return merged
@@ -0,0 +1,758 @@
+import os
+import json
+import time
+import datetime
+import hashlib
+import random
+import zlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures import TimeoutError as FutureTimeout
+from functools import partial
+import pandas as pd
+
+import http_session
+import price_store
+import trading_calendar
+
+# --- 設定: 記録・再生プロバイダ ---
+RECORD_DIR = os.environ.get("PRICE_RECORD_DIR", "recordings")
+CSV_DROP_DIR = os.environ.get("PRICE_CSV_DIR", "csv_drop")
+REQUEST_TIMEOUT = 20         # yfinanceの1リクエストあたりのタイムアウト (秒)
+
+# --- 設定: 応答キャッシュ ---
+RESPONSE_CACHE_DIR = os.environ.get("RESPONSE_CACHE_DIR", "response_cache")
+CACHE_MAX_MB = 200           # キャッシュの上限サイズ (MB)。超えたら最後に使ってから長いものから削除する
+CACHE_EXPIRE_AT = (15, 30)   # キャッシュの有効期限 = 次の大引け (日本時間) + CACHE_SETTLE_DELAY
+CACHE_SETTLE_DELAY = 20      # 取得元の東証データの遅延 (分)。大引けからこの時間が過ぎるまで当日の足を確定とみなさない
+JST = datetime.timezone(datetime.timedelta(hours=9))
+
+# --- 設定: フェイルオーバー ---
+FAILOVER_TIMEOUT = 10.0      # 1つの取得元を待つ時間 (秒、呼び出しの実行開始から)。超えたら次の取得元へ切り替える
+FAILOVER_MAX_WORKERS = 32    # 並行数の指定が無い場合のフェイルオーバー用スレッド数
+QUALITY_TOLERANCE = 0.005    # 取得元間の終値の許容乖離率 (配当調整の有無程度の差は許容)
+
+
+# 終了時に止めるスレッドプール (フェイルオーバー用)。shutdown_executors で待機中のスレッドを終わらせる
+_executors = []
+_executors_lock = threading.Lock()
+
+
+def shutdown_executors():
+    """
+    プロバイダが作ったスレッドプールを閉じる (終了を待たない)
+    待機中のスレッドはすぐに終わり、実行中の呼び出しのスレッドだけが残る
+    """
+    with _executors_lock:
+        executors = list(_executors)
+        _executors.clear()
+    for executor in executors:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ProviderError(Exception):
+    """プロバイダが応答を返せなかった"""
+
+
+class InjectedFailure(ConnectionError):
+    """再生プロバイダが意図的に発生させた障害 (再試行の対象になるよう ConnectionError を継承)"""
+
+
+def to_date_str(start):
+    """開始日を 'YYYY-MM-DD' 文字列に揃える"""
+    if start is None:
+        return None
+    return pd.Timestamp(start).strftime('%Y-%m-%d')
+
+
+def period_offset(period):
+    """yfinance形式の期間 ('5d', '3mo', '2y' など) を DateOffset に変換する ('max' は None)"""
+    if period is None or period == "max":
+        return None
+    if period.endswith("mo"):
+        return pd.DateOffset(months=int(period[:-2]))
+    if period.endswith("wk"):
+        return pd.DateOffset(weeks=int(period[:-2]))
+    if period.endswith("y"):
+        return pd.DateOffset(years=int(period[:-1]))
+    if period.endswith("d"):
+        return pd.DateOffset(days=int(period[:-1]))
+    raise ValueError(f"未対応の期間指定です: {period}")
+
+
+def slice_history(df, period=None, start=None, end=None):
+    """
+    記録済みデータを期間・開始日で切り出す
+    period は最終日付を基準に数える (再生結果を実行日に依存させないため)
+    """
+    if df.empty:
+        return df
+    if start is not None:
+        df = df[df.index >= pd.Timestamp(start)]
+    elif period is not None:
+        offset = period_offset(period)
+        if offset is not None:
+            df = df[df.index > df.index[-1] - offset]
+    if end is not None:
+        df = df[df.index < pd.Timestamp(end)]
+    return df
+
+
+class PriceProvider:
+    """
+    株価データの取得元の共通インターフェース
+    戻り値はストア形式 (tzなし日付インデックス × OHLCV) のデータフレーム
+    """
+
+    name = "base"
+
+    def history(self, ticker, period=None, start=None):
+        raise NotImplementedError
+
+    def latest_date(self, ticker):
+        """
+        取得できる最新の日付。None = 今日 (ライブの取得元)
+        記録を再生する取得元では記録の最終日を返し、取得期間をそこから数えられるようにする
+        内側のプロバイダを包むプロバイダは内側の値を返す
+        """
+        inner = getattr(self, "inner", None)
+        return inner.latest_date(ticker) if inner is not None else None
+
+    def download(self, tickers, period=None, start=None):
+        """
+        複数ティッカーをまとめて取得し {ticker: データフレーム} を返す
+        一括取得に対応しないプロバイダは1件ずつ取得する (取得できなかったティッカーは含めない)
+        """
+        frames = {}
+        for ticker in tickers:
+            try:
+                df = self.history(ticker, period=period, start=start)
+            except Exception as e:
+                print(f"取得エラー {ticker} ({self.name}): {e}")
+                continue
+            if not df.empty:
+                frames[ticker] = df
+        return frames
+
+
+class YahooProvider(PriceProvider):
+    """Yahoo! Finance (yfinance) から取得する (応答しない接続で止まらないよう必ずタイムアウトを付ける)"""
+
+    name = "yahoo"
+
+    def __init__(self, timeout=REQUEST_TIMEOUT):
+        self.timeout = timeout
+
+    def history(self, ticker, period=None, start=None):
+        import yfinance as yf
+
+        stock = yf.Ticker(ticker, session=http_session.get_yahoo_session())
+        if start is not None:
+            hist = stock.history(start=to_date_str(start), timeout=self.timeout)
+        else:
+            hist = stock.history(period=period, timeout=self.timeout)
+        return price_store.normalize_ohlcv(hist)
+
+    def download(self, tickers, period=None, start=None):
+        import yfinance as yf
+
+        kwargs = {"period": period} if start is None else {"start": to_date_str(start)}
+        data = yf.download(
+            list(tickers), group_by="ticker", auto_adjust=True, actions=False,
+            threads=False, progress=False, timeout=self.timeout,
+            session=http_session.get_yahoo_session(), **kwargs
+        )
+
+        frames = {}
+        if data is None or data.empty:
+            return frames
+
+        for ticker in tickers:
+            if isinstance(data.columns, pd.MultiIndex):
+                if ticker not in data.columns.get_level_values(0):
+                    continue
+                df = data[ticker]
+            else:
+                # 単一ティッカーの場合は列がフラットで返ることがある
+                df = data
+            df = price_store.normalize_ohlcv(df.dropna(how="all"))
+            if not df.empty:
+                frames[ticker] = df
+        return frames
+
+
+class RecordingProvider(PriceProvider):
+    """
+    内側のプロバイダの応答をそのまま返しつつ、ティッカーごとのCSVに記録する
+    記録は既存ファイルにマージするため、差分取得を繰り返しても全期間が残る
+    """
+
+    name = "record"
+
+    def __init__(self, inner, record_dir=None):
+        self.inner = inner
+        self.record_dir = record_dir or RECORD_DIR
+        self._lock = threading.Lock()
+
+    def _record(self, ticker, df):
+        if df.empty:
+            return
+        with self._lock:
+            stored = price_store.load_prices(ticker, self.record_dir)
+            price_store.save_prices(ticker, price_store.merge_prices(stored, df), self.record_dir)
+
+    def history(self, ticker, period=None, start=None):
+        df = self.inner.history(ticker, period=period, start=start)
+        self._record(ticker, df)
+        return df
+
+    def download(self, tickers, period=None, start=None):
+        frames = self.inner.download(tickers, period=period, start=start)
+        for ticker, df in frames.items():
+            self._record(ticker, df)
+        return frames
+
+
+class ReplayProvider(PriceProvider):
+    """
+    RecordingProvider で記録したファイルを再生する (ネットワーク不要)
+    latency / jitter 秒の遅延と failure_rate の確率の障害を注入できる
+    注入は (seed, ティッカー, 呼び出し回数) から決まるため、同じ設定なら毎回同じ結果になる
+    synthesize=True の場合、記録のないティッカーには記録済みデータを価格倍率を変えて割り当てる
+    """
+
+    name = "replay"
+
+    def __init__(self, record_dir=None, latency=0.0, jitter=0.0, failure_rate=0.0,
+                 seed=0, synthesize=False):
+        self.record_dir = record_dir or RECORD_DIR
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.seed = seed
+        self.synthesize = synthesize
+        self._frames = {}
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def recorded_tickers(self):
+        if not os.path.isdir(self.record_dir):
+            return []
+        return sorted(f[:-4] for f in os.listdir(self.record_dir) if f.endswith(".csv"))
+
+    def _load(self, ticker):
+        with self._lock:
+            if ticker in self._frames:
+                return self._frames[ticker]
+
+        df = price_store.load_prices(ticker, self.record_dir)
+        if df is None and self.synthesize:
+            recorded = self.recorded_tickers()
+            if recorded:
+                source = recorded[zlib.crc32(ticker.encode()) % len(recorded)]
+                df = price_store.load_prices(source, self.record_dir)
+                if df is not None:
+                    # 同じ元データでも銘柄ごとに価格水準が変わるようにする
+                    scale = 0.5 + (zlib.crc32(f"scale:{ticker}".encode()) % 1000) / 1000
+                    df = df.copy()
+                    for col in ["Open", "High", "Low", "Close"]:
+                        if col in df.columns:
+                            df[col] = df[col] * scale
+
+        with self._lock:
+            self._frames[ticker] = df
+        return df
+
+    def _inject(self, ticker):
+        with self._lock:
+            n = self._calls.get(ticker, 0)
+            self._calls[ticker] = n + 1
+        rng = random.Random(f"{self.seed}:{ticker}:{n}")
+
+        delay = self.latency + rng.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if rng.random() < self.failure_rate:
+            raise InjectedFailure(f"{ticker}: 再生プロバイダの注入障害 (呼び出し{n + 1}回目)")
+
+    def latest_date(self, ticker):
+        df = self._load(ticker)
+        if df is None or df.empty:
+            return None
+        return df.index[-1].date()
+
+    def history(self, ticker, period=None, start=None):
+        self._inject(ticker)
+        df = self._load(ticker)
+        if df is None:
+            raise ProviderError(f"{ticker}: 記録がありません ({self.record_dir})")
+        return slice_history(df, period=period, start=start)
+
+    def download(self, tickers, period=None, start=None):
+        # 一括取得は1回の呼び出しとして遅延・障害を注入する
+        self._inject(",".join(tickers))
+        frames = {}
+        for ticker in tickers:
+            df = self._load(ticker)
+            if df is not None:
+                df = slice_history(df, period=period, start=start)
+                if not df.empty:
+                    frames[ticker] = df
+        return frames
+
+
+class CsvDropProvider(PriceProvider):
+    """
+    ローカルに置かれたCSV (手動ダウンロード等) から取得する
+    ファイル名は '{ティッカー}.csv' または '{コード}.csv' (例: 1617.T.csv / 1617.csv)
+    """
+
+    name = "csv"
+
+    def __init__(self, drop_dir=None):
+        self.drop_dir = drop_dir or CSV_DROP_DIR
+
+    def history(self, ticker, period=None, start=None):
+        for filename in [f"{ticker}.csv", f"{ticker.split('.')[0]}.csv"]:
+            path = os.path.join(self.drop_dir, filename)
+            if os.path.exists(path):
+                df = pd.read_csv(path, index_col=0, parse_dates=True)
+                return slice_history(price_store.normalize_ohlcv(df), period=period, start=start)
+        raise ProviderError(f"{ticker}: CSVがありません ({self.drop_dir})")
+
+
+def compare_frames(primary, other, tolerance):
+    """
+    2つの取得元の終値を重複期間で比較し、最大乖離率を返す (重複がなければ None)
+    """
+    common = primary.index.intersection(other.index)
+    if len(common) == 0:
+        return None
+    a = primary.loc[common, "Close"].astype(float)
+    b = other.loc[common, "Close"].astype(float)
+    return float(((a - b).abs() / b.abs().clip(lower=1e-9)).max())
+
+
+class FailoverProvider(PriceProvider):
+    """
+    複数の取得元を優先順に試す
+    - 通常: 先頭から順に呼び出し、タイムアウト・エラー・空データなら次の取得元へ切り替える
+    - race=True: 全取得元へ同時に要求し、最初に揃った応答を採用する
+      verify=True なら残りの応答を待たずに採用し、後から届いた応答と終値を突き合わせて品質を記録する
+    一括取得 (download) は順番に試し、取得できなかったティッカーだけを次の取得元へ回す
+    タイムアウトは呼び出しが実行を始めてから数える (プールの空き待ちで切り替えない)
+    max_concurrency: 呼び出し元の並行数の上限。ヘッジ要求と、タイムアウト後も終わらない呼び出しの分を見込んで
+    (上限 × 2) × 取得元の数 のスレッドを確保する
+    """
+
+    def __init__(self, providers, timeout=FAILOVER_TIMEOUT, race=False, verify=True,
+                 tolerance=QUALITY_TOLERANCE, max_concurrency=None):
+        self.providers = list(providers)
+        self.name = ",".join(p.name for p in self.providers)
+        self.timeout = timeout
+        self.race = race
+        self.verify = verify
+        self.tolerance = tolerance
+        # 応答待ちのスレッドはタイムアウト後も止められないため、終了を待たない専用プールで実行する
+        workers = max_concurrency * 2 * len(self.providers) if max_concurrency else FAILOVER_MAX_WORKERS
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="failover")
+        with _executors_lock:
+            _executors.append(self._executor)
+        self._lock = threading.Lock()
+        self.stats = {"served_by": {}, "failovers": 0, "errors": [], "quality": []}
+
+    def _record(self, key, value):
+        with self._lock:
+            if key == "served_by":
+                self.stats["served_by"][value] = self.stats["served_by"].get(value, 0) + 1
+            elif key == "failovers":
+                self.stats["failovers"] += 1
+            else:
+                self.stats[key].append(value)
+
+    def latest_date(self, ticker):
+        # 通常応答する先頭の取得元に合わせる
+        return self.providers[0].latest_date(ticker)
+
+    def _submit(self, started, fn, *args, **kwargs):
+        """専用プールで fn を実行する。実行を始めた時点で started (threading.Event) を立てる"""
+        def call():
+            started.set()
+            return fn(*args, **kwargs)
+        return self._executor.submit(call)
+
+    def history(self, ticker, period=None, start=None):
+        if self.race:
+            return self._race(ticker, period, start)
+
+        errors = []
+        for i, provider in enumerate(self.providers):
+            started = threading.Event()
+            future = self._submit(started, provider.history, ticker, period=period, start=start)
+            try:
+                started.wait()
+                df = future.result(timeout=self.timeout)
+                if df.empty:
+                    raise ProviderError("データが空です")
+            except Exception as e:
+                reason = "timeout" if isinstance(e, FutureTimeout) else f"{type(e).__name__}: {e}"
+                errors.append(f"{provider.name}: {reason}")
+                self._record("errors", {"ticker": ticker, "provider": provider.name, "error": reason})
+                if i + 1 < len(self.providers):
+                    self._record("failovers", None)
+                continue
+            self._record("served_by", provider.name)
+            return df
+        raise ProviderError(f"{ticker}: 全ての取得元が失敗しました ({'; '.join(errors)})")
+
+    def _race(self, ticker, period, start):
+        started = threading.Event()
+        futures = {
+            self._submit(started, p.history, ticker, period=period, start=start): p
+            for p in self.providers
+        }
+        pending = set(futures)
+        errors = []
+        # いずれかの呼び出しが実行を始めてから数える
+        started.wait()
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+
+        while pending:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                provider = futures[future]
+                try:
+                    df = future.result()
+                    if df.empty:
+                        raise ProviderError("データが空です")
+                except Exception as e:
+                    errors.append(f"{provider.name}: {type(e).__name__}: {e}")
+                    continue
+
+                self._record("served_by", provider.name)
+                if self.verify:
+                    for other in pending:
+                        other.add_done_callback(
+                            partial(self._verify, ticker, provider.name, df, futures[other].name)
+                        )
+                return df
+
+        if pending:
+            errors.append("timeout")
+        raise ProviderError(f"{ticker}: 全ての取得元が失敗しました ({'; '.join(errors)})")
+
+    def _verify(self, ticker, winner, df, other_name, future):
+        """採用した応答と、後から届いた別の取得元の応答を突き合わせる"""
+        try:
+            other = future.result()
+        except Exception:
+            return
+        deviation = compare_frames(df, other, self.tolerance)
+        if deviation is None:
+            return
+        entry = {
+            "ticker": ticker, "served_by": winner, "compared_with": other_name,
+            "max_deviation": round(deviation, 6), "ok": deviation <= self.tolerance,
+        }
+        self._record("quality", entry)
+        if not entry["ok"]:
+            print(f"警告: 取得元間で終値が一致しません {ticker} ({winner} vs {other_name}): 最大乖離 {deviation:.4%}")
+
+    def download(self, tickers, period=None, start=None):
+        frames = {}
+        remaining = list(tickers)
+        for i, provider in enumerate(self.providers):
+            if not remaining:
+                break
+            try:
+                got = provider.download(remaining, period=period, start=start)
+            except Exception as e:
+                self._record("errors", {"ticker": ",".join(remaining), "provider": provider.name,
+                                        "error": f"{type(e).__name__}: {e}"})
+                got = {}
+            for ticker, df in got.items():
+                frames[ticker] = df
+                self._record("served_by", provider.name)
+            remaining = [t for t in remaining if t not in frames]
+            if remaining and i + 1 < len(self.providers):
+                self._record("failovers", None)
+        return frames
+
+
+class SingleFlightProvider(PriceProvider):
+    """
+    同じ要求 (ティッカー・期間・開始日) が同時に来た場合に、取得を1回にまとめて結果を共有する
+    複数のユニバースに同じティッカーが含まれていても、実行中の取得に相乗りするため通信は増えない
+    取得が終わった要求は保持しない (結果のキャッシュではなく、実行中の要求の合流のみ)
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.name = inner.name
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.flights = {"requests": 0, "coalesced": 0}
+
+    @property
+    def stats(self):
+        return getattr(self.inner, "stats", None)
+
+    def _do(self, key, fn):
+        """key の取得が実行中ならその結果を待ち、無ければ fn() を実行して待っている呼び出し元と共有する"""
+        with self._lock:
+            self.flights["requests"] += 1
+            future = self._flights.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._flights[key] = future
+            else:
+                self.flights["coalesced"] += 1
+
+        if not leader:
+            # 相乗りした側は結果のコピーを受け取る (呼び出し元どうしで同じデータフレームを書き換えないように)
+            return _copy_result(future.result())
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+
+    def history(self, ticker, period=None, start=None):
+        key = ("history", ticker, period, to_date_str(start))
+        return self._do(key, partial(self.inner.history, ticker, period=period, start=start))
+
+    def download(self, tickers, period=None, start=None):
+        key = ("download", tuple(tickers), period, to_date_str(start))
+        return self._do(key, partial(self.inner.download, tickers, period=period, start=start))
+
+
+def _copy_result(result):
+    if isinstance(result, dict):
+        return {k: v.copy() for k, v in result.items()}
+    return result.copy()
+
+
+def without_single_flight(provider):
+    """合流させずに取得したい場合 (ヘッジ要求など) に使う、内側のプロバイダ (応答キャッシュは通す)"""
+    if isinstance(provider, SingleFlightProvider):
+        return provider.inner
+    return provider
+
+
+def next_close(now, close=CACHE_EXPIRE_AT, delay=CACHE_SETTLE_DELAY):
+    """
+    now (日本時間) の後に来る最初の「大引け + データ遅延 (delay 分)」の時刻と、now 時点で足が確定している最新の取引日を返す
+    大引け直後は取得元のデータが遅延しており当日の足が確定前のことがあるため、delay 分が過ぎるまでは前の取引日を返す
+    """
+    day = now.date()
+    today_settle = now.replace(hour=close[0], minute=close[1], second=0, microsecond=0) \
+        + datetime.timedelta(minutes=delay)
+    if trading_calendar.is_trading_day(day) and now < today_settle:
+        return today_settle, trading_calendar.previous_trading_day(day)
+
+    settled = day if trading_calendar.is_trading_day(day) else trading_calendar.previous_trading_day(day)
+    expires = datetime.datetime.combine(
+        trading_calendar.next_trading_day(day), today_settle.timetz()
+    )
+    return expires, settled
+
+
+class CachingProvider(PriceProvider):
+    """
+    応答をディスクにキャッシュする (同じ日の再実行で取得元へ問い合わせない)
+    - キーは要求の内容 (取得元・メソッド・ティッカー・期間) と確定済みの最新取引日
+      開始日はキーに含めず、保存した応答の開始日以降を要求する場合は保存した応答を切り出して返す
+      (差分取得の開始日はストアに足が増えるたびに進むため、開始日をキーにすると同じ日の再実行で当たらない)
+    - 有効期限は次の大引け + データ遅延まで。確定済みの最新取引日の足で終わらない応答は保存しない
+      (引け後に当日の足がまだ無い、取引時間中や引け直後の確定前の足を含むなど)
+    - 合計サイズが max_bytes を超えたら、最後に使ってから長いエントリから削除する (LRU)
+    エントリは '{ハッシュ}.csv' (ティッカー列付きのOHLCV) と '{ハッシュ}.json' (キー・有効期限) の2ファイル
+    """
+
+    def __init__(self, inner, cache_dir=None, max_bytes=CACHE_MAX_MB * 1024 * 1024,
+                 close=CACHE_EXPIRE_AT):
+        self.inner = inner
+        self.name = inner.name
+        self.cache_dir = cache_dir or RESPONSE_CACHE_DIR
+        self.max_bytes = max_bytes
+        self.close = close
+        self._lock = threading.Lock()
+        self.cache_stats = {"hits": 0, "misses": 0, "stored": 0, "evicted": 0}
+
+    @property
+    def stats(self):
+        return getattr(self.inner, "stats", None)
+
+    def _count(self, key):
+        with self._lock:
+            self.cache_stats[key] += 1
+
+    def _paths(self, key):
+        digest = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+        base = os.path.join(self.cache_dir, digest)
+        return base + ".csv", base + ".json"
+
+    def _load(self, key, start):
+        """保存した応答が start 以降を含んでいれば、start で切り出して返す"""
+        csv_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("key") != key or time.time() >= meta["expires_at"]:
+                return None
+            # 開始日なしの要求 (全期間・期間指定) はどの開始日の要求も含む
+            cached_start = meta.get("start")
+            if cached_start is not None and (start is None or cached_start > start):
+                return None
+            df = pd.read_csv(csv_path, index_col="Date", parse_dates=["Date"])
+            os.utime(meta_path)  # 最終利用時刻 (LRU) を更新する
+        except (OSError, ValueError, KeyError):
+            return None
+
+        frames = {}
+        for ticker, group in df.groupby("Ticker", sort=False):
+            frames[ticker] = slice_history(price_store.normalize_ohlcv(group.drop(columns="Ticker")), start=start)
+        return frames
+
+    def _store(self, key, start, frames, expires, settled):
+        if not frames or any(df.empty or df.index[-1].date() != settled for df in frames.values()):
+            return
+
+        csv_path, meta_path = self._paths(key)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            df = pd.concat([df.assign(Ticker=ticker) for ticker, df in frames.items()])
+            suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+            df.to_csv(csv_path + suffix, date_format="%Y-%m-%d")
+            os.replace(csv_path + suffix, csv_path)
+            with open(meta_path + suffix, "w", encoding="utf-8") as f:
+                json.dump({"key": key, "start": start, "expires_at": expires.timestamp()}, f, ensure_ascii=False)
+            os.replace(meta_path + suffix, meta_path)
+        except OSError as e:
+            print(f"キャッシュ保存エラー: {e}")
+            return
+        self._count("stored")
+        self._evict()
+
+    def _evict(self):
+        """期限切れのエントリと、上限サイズを超えた分の古いエントリを削除する"""
+        entries = []
+        now = time.time()
+        with self._lock:
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith(".json"):
+                    continue
+                meta_path = os.path.join(self.cache_dir, name)
+                csv_path = meta_path[:-5] + ".csv"
+                try:
+                    with open(meta_path, encoding="utf-8") as f:
+                        expired = json.load(f).get("expires_at", 0) <= now
+                    size = os.path.getsize(csv_path) + os.path.getsize(meta_path)
+                    used = os.path.getmtime(meta_path)
+                except (OSError, ValueError):
+                    continue
+                entries.append((expired, used, size, meta_path, csv_path))
+
+            total = sum(e[2] for e in entries)
+            # 期限切れを先に、次に最後に使ってから長い順に消す
+            for expired, used, size, meta_path, csv_path in sorted(entries, key=lambda e: (not e[0], e[1])):
+                if not expired and total <= self.max_bytes:
+                    break
+                for path in (meta_path, csv_path):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                total -= size
+                self.cache_stats["evicted"] += 1
+
+    def _cached(self, key, start, fetch):
+        expires, settled = next_close(datetime.datetime.now(JST), self.close)
+        key = key + [settled.isoformat()]
+        start = to_date_str(start)
+        frames = self._load(key, start)
+        if frames is not None:
+            self._count("hits")
+            return frames
+        self._count("misses")
+        frames = fetch()
+        self._store(key, start, frames, expires, settled)
+        return frames
+
+    def history(self, ticker, period=None, start=None):
+        def fetch():
+            df = self.inner.history(ticker, period=period, start=start)
+            return {ticker: df} if not df.empty else {}
+
+        frames = self._cached([self.inner.name, "history", ticker, period], start, fetch)
+        return frames.get(ticker, price_store.normalize_ohlcv(None))
+
+    def download(self, tickers, period=None, start=None):
+        return self._cached(
+            [self.inner.name, "download", list(tickers), period], start,
+            lambda: self.inner.download(tickers, period=period, start=start)
+        )
+
+
+def as_provider(provider):
+    """プロバイダのリスト (優先順) が渡された場合はフェイルオーバーでまとめる"""
+    if isinstance(provider, (list, tuple)):
+        if len(provider) == 1:
+            return provider[0]
+        return FailoverProvider(provider)
+    return provider
+
+
+def make_provider(name="yahoo", record_dir=None, latency=0.0, jitter=0.0, failure_rate=0.0,
+                  seed=0, synthesize=False, csv_dir=None, failover_timeout=FAILOVER_TIMEOUT,
+                  race=False, single_flight=False, cache_dir=None, cache_max_mb=CACHE_MAX_MB,
+                  max_concurrency=None):
+    """
+    名前からプロバイダを生成する (yahoo / record / replay / csv)
+    'yahoo,csv' のようにカンマ区切りで指定した場合は優先順のフェイルオーバーにする
+    single_flight=True の場合、同時に来た同じ要求を1回の取得にまとめる
+    cache_dir を指定した場合、応答をディスクにキャッシュする (次の大引けまで有効)
+    max_concurrency: 取得の並行数の上限 (フェイルオーバーのスレッド数をこれに合わせる)
+    """
+    if single_flight:
+        return SingleFlightProvider(
+            make_provider(name, record_dir, latency, jitter, failure_rate, seed, synthesize,
+                          csv_dir, failover_timeout, race, cache_dir=cache_dir, cache_max_mb=cache_max_mb,
+                          max_concurrency=max_concurrency)
+        )
+    if cache_dir:
+        return CachingProvider(
+            make_provider(name, record_dir, latency, jitter, failure_rate, seed, synthesize,
+                          csv_dir, failover_timeout, race, max_concurrency=max_concurrency),
+            cache_dir, max_bytes=int(cache_max_mb * 1024 * 1024)
+        )
+
+    names = [n.strip() for n in name.split(",") if n.strip()]
+    if len(names) > 1:
+        chain = [
+            make_provider(n, record_dir, latency, jitter, failure_rate, seed, synthesize, csv_dir)
+            for n in names
+        ]
+        return FailoverProvider(chain, timeout=failover_timeout, race=race, max_concurrency=max_concurrency)
+
+    if name == "yahoo":
+        return YahooProvider()
+    if name == "record":
+        return RecordingProvider(YahooProvider(), record_dir)
+    if name == "replay":
+        return ReplayProvider(record_dir, latency=latency, jitter=jitter,
+                              failure_rate=failure_rate, seed=seed, synthesize=synthesize)
+    if name == "csv":
+        return CsvDropProvider(csv_dir)
+    raise ValueError(f"不明なプロバイダです: {name}")
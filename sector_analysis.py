@@ -1,10 +1,34 @@
-import yfinance as yf
 import pandas as pd
 import numpy as np
 import json
 import datetime
 import os
-from concurrent.futures import ThreadPoolExecutor
+import argparse
+import heapq
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
+
+try:
+    import resource
+except ImportError:  # Windows ではピークメモリを記録しない
+    resource = None
+
+import fetch_engine
+import http_session
+import indicators
+from deadline import Deadline, RUN_DEADLINE_ENV
+import price_store
+import providers
+import shard_queue
+import trading_calendar
 
 # --- 設定: TOPIX-17業種 ETFリスト ---
 SECTOR_ETFS = {
@@ -27,37 +51,82 @@ SECTOR_ETFS = {
     "1633": "不動産"
 }
 
-def calculate_technical_indicators(df):
-    """データフレーム全体に対してテクニカル指標を一括計算する"""
+JST = datetime.timezone(datetime.timedelta(hours=9))
+MARKET_CLOSE = (15, 30)      # 東証の大引け (日本時間)
+MARKET_DATA_DELAY = 20       # 取得元の東証データの遅延 (分)。大引けからこの時間が過ぎるまで当日の足は確定しない
+CLOSE_CHECK_PERIOD = "5d"    # 引け確認で取得する期間 (当日の足の有無だけを見る)
+CLOSE_POLL_INTERVAL = 20.0   # 引け確認の初回の待ち時間 (秒)。以降1.5倍ずつ延ばす
+CLOSE_POLL_MAX_INTERVAL = 120.0  # 引け確認の待ち時間の上限 (秒)
+CLOSE_MAX_WAIT = 1800.0      # 大引け後に当日の足を待つ最大時間 (秒)
+PUBLISH_RESERVE = 90         # 実行期限のうち投稿 (wordpress_publisher.py) のために残す時間 (秒)
+COMPUTE_RESERVE = 30         # 取得の期限から指標計算・保存のために残す時間 (秒)
+EXIT_GRACE = 1.0             # 終了時に残ったスレッドの終了を待つ時間 (秒)。過ぎても実行中なら待たずに終了する
+
+# --- 設定: 指標と出力期間 ---
+# 取得・計算する本数は「出力本数 + 最も長い指標の助走期間」から決まる (期間を延ばすと取得期間も自動で延びる)
+OUTPUT_ROWS = 250            # 出力する本数 (直近1年 = 250営業日)
+MA_WINDOWS = {"diff_short": 5, "diff_mid": 25, "diff_long": 75}  # 移動平均乖離率の列と期間
+RSI_WINDOW = 14              # RSIの期間
+BB_WINDOW = 20               # ボリンジャーバンドの期間
+BB_SIGMA = 2                 # ボリンジャーバンドの幅 (σ)
+VOLUME_WINDOW = 5            # 出来高倍率の比較期間
+
+# --- 設定: データ取得 ---
+FETCH_MARGIN_BARS = 10       # ストアが空の場合の取得期間に足す余裕 (臨時休場・欠けた足の分)
+TRADING_DAYS_PER_YEAR = 245  # 暦日換算に使う1年あたりの取引日数 (祝日判定が外れても取得期間が足りるようにする)
+STORE_OVERLAP_BARS = 5       # 差分取得時に保存済みデータと重ねて取得する本数 (修正検出用)
+OUTPUT_FILE = 'sector_data.json'    # 出力 (全銘柄の行) の保存先
+METADATA_FILE = 'sector_meta.json'  # 取得統計などの実行メタデータの出力先
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", "snapshots")  # 最後に全セクターを正常に取得できた出力の保存先
+FETCH_STATE_DIR = os.environ.get("FETCH_STATE_DIR", "fetch_state")  # サーキット状態など実行間で引き継ぐ状態
+STREAM_STATE_FILE = "indicator_state.json"  # 逐次計算の状態 (FETCH_STATE_DIR 内)
+REPLAY_DIR = os.environ.get("REPLAY_DIR", "replay")  # 再生 (--provider replay) 時の株価ストア・状態・スナップショットの既定の置き場所
+STREAM_VERIFY_EVERY = 20     # 逐次計算をこの回数ごとに全期間の再計算と照合し、状態を作り直す
+PIPELINE_WORKERS = 4         # --pipeline で取得済みの銘柄の計算・JSON化を進めるスレッド数
+SHARD_QUEUE_DIR = os.environ.get("SHARD_QUEUE_DIR", "shard_queue")  # シャード分割時のファイルキューの置き場所
+# --shard-worker が自分の指定をそのままシャードの実行に引き継ぐ引数 (銘柄の集合と取得元。--shard-args の指定が優先)
+SHARD_FORWARD_ARGS = [
+    "universe_size", "provider", "record_dir", "store_dir", "csv_dir",
+    "replay_latency", "replay_jitter", "replay_failure_rate", "replay_seed",
+]
+# 取得失敗時の扱い: fail = 出力せず異常終了 / last-good = 保存済みデータで補う / stale = 保存済みデータで補い「未更新」と明示する
+MISSING_POLICY = os.environ.get("MISSING_POLICY", "stale")
+BATCH_SIZE = int(os.environ.get("FETCH_BATCH_SIZE", "0"))  # 一括取得の1リクエストあたり件数 (0 = 銘柄ごとに取得)
+DEFAULT_PROVIDER = providers.YahooProvider()
+
+def calculate_technical_indicators(df, lean=False, dtype=None):
+    """
+    データフレーム全体に対してテクニカル指標を一括計算する
+    lean=True (または dtype 指定) の場合は calculate_lean_indicators で計算する
+    """
+    if lean or dtype is not None:
+        return calculate_lean_indicators(df, dtype)
     df = df.copy()
     
     # 1. 移動平均乖離率
-    df['ma5'] = df['Close'].rolling(window=5).mean()
-    df['ma25'] = df['Close'].rolling(window=25).mean()
-    df['ma75'] = df['Close'].rolling(window=75).mean()
-    
-    df['diff_short'] = ((df['Close'] - df['ma5']) / df['ma5']) * 100
-    df['diff_mid'] = ((df['Close'] - df['ma25']) / df['ma25']) * 100
-    df['diff_long'] = ((df['Close'] - df['ma75']) / df['ma75']) * 100
+    for column, window in MA_WINDOWS.items():
+        df[f'ma{window}'] = df['Close'].rolling(window=window).mean()
+    for column, window in MA_WINDOWS.items():
+        df[column] = ((df['Close'] - df[f'ma{window}']) / df[f'ma{window}']) * 100
 
     # 2. RSI (14日)
     delta = df['Close'].diff()
-    gain = (delta.where(delta > 0, 0)).rolling(window=14).mean()
-    loss = (-delta.where(delta < 0, 0)).rolling(window=14).mean()
+    gain = (delta.where(delta > 0, 0)).rolling(window=RSI_WINDOW).mean()
+    loss = (-delta.where(delta < 0, 0)).rolling(window=RSI_WINDOW).mean()
     rs = gain / loss
     df['rsi'] = 100 - (100 / (1 + rs))
 
     # 3. ボリンジャーバンド %B (20日, 2σ)
-    df['bb_ma'] = df['Close'].rolling(window=20).mean()
-    df['bb_std'] = df['Close'].rolling(window=20).std()
-    df['bb_up'] = df['bb_ma'] + (df['bb_std'] * 2)
-    df['bb_low'] = df['bb_ma'] - (df['bb_std'] * 2)
+    df['bb_ma'] = df['Close'].rolling(window=BB_WINDOW).mean()
+    df['bb_std'] = df['Close'].rolling(window=BB_WINDOW).std()
+    df['bb_up'] = df['bb_ma'] + (df['bb_std'] * BB_SIGMA)
+    df['bb_low'] = df['bb_ma'] - (df['bb_std'] * BB_SIGMA)
     
     bb_range = df['bb_up'] - df['bb_low']
     df['bb_pct_b'] = np.where(bb_range == 0, 0, (df['Close'] - df['bb_low']) / bb_range)
 
     # 4. 出来高倍率 (直近5日平均との比較)
-    df['vol_ma5'] = df['Volume'].rolling(window=5).mean()
+    df['vol_ma5'] = df['Volume'].rolling(window=VOLUME_WINDOW).mean()
     df['vol_ratio'] = np.where(df['vol_ma5'] == 0, 0, df['Volume'] / df['vol_ma5'])
 
     # 5. 前日比
@@ -65,46 +134,274 @@ def calculate_technical_indicators(df):
 
     return df
 
-def get_sector_data(code, name):
+def calculate_lean_indicators(df, dtype=None):
+    """
+    calculate_technical_indicators の省メモリ版 (値は同じ)
+    入力のコピーを作らずに終値・出来高だけを使い、中間値 (移動平均・バンドなど) は列に残さず使い終わったら捨てる
+    戻り値は出力の列 (OUTPUT_FIELDS) だけのデータフレーム。dtype (np.float32 など) を指定すると指標をその型で持つ
+    使わない列 (始値など) が NaN の行は、dropna と同じく NaN にして出力から除く
+    """
+    close = df['Close']
+    out = {'Close': close}
+
+    # 1. 移動平均乖離率
+    for column, window in MA_WINDOWS.items():
+        ma = close.rolling(window=window).mean()
+        out[column] = ((close - ma) / ma) * 100
+        del ma
+
+    # 2. RSI
+    delta = close.diff()
+    gain = (delta.where(delta > 0, 0)).rolling(window=RSI_WINDOW).mean()
+    loss = (-delta.where(delta < 0, 0)).rolling(window=RSI_WINDOW).mean()
+    del delta
+    out['rsi'] = 100 - (100 / (1 + gain / loss))
+    del gain, loss
+
+    # 3. ボリンジャーバンド %B
+    bb_ma = close.rolling(window=BB_WINDOW).mean()
+    bb_std = close.rolling(window=BB_WINDOW).std()
+    bb_up = bb_ma + (bb_std * BB_SIGMA)
+    bb_low = bb_ma - (bb_std * BB_SIGMA)
+    del bb_ma, bb_std
+    bb_range = bb_up - bb_low
+    out['bb_pct_b'] = np.where(bb_range == 0, 0, (close - bb_low) / bb_range)
+    del bb_up, bb_low, bb_range
+
+    # 4. 出来高倍率
+    vol_ma = df['Volume'].rolling(window=VOLUME_WINDOW).mean()
+    out['vol_ratio'] = np.where(vol_ma == 0, 0, df['Volume'] / vol_ma)
+    del vol_ma
+
+    # 5. 前日比
+    out['change_pct'] = close.pct_change() * 100
+
+    result = pd.DataFrame({column: out[column] for _, column, _ in OUTPUT_FIELDS}, index=df.index)
+    del out
+    if dtype is not None:
+        result = result.astype({column: dtype for column in OUTPUT_INDICATORS})
+    unused = [col for col in price_store.OHLCV_COLUMNS if col in df.columns and col not in ('Close', 'Volume')]
+    if unused:
+        result[df[unused].isna().any(axis=1).to_numpy()] = np.nan
+    return result
+
+def indicator_graph():
+    """
+    出力する指標の依存グラフ (indicators.build_graph)。共有できる移動窓は1回だけ計算する
+    calculate_technical_indicators と同じ指標を、同じ期間の設定から組み立てる
+    """
+    return indicators.build_graph(MA_WINDOWS, RSI_WINDOW, BB_WINDOW, BB_SIGMA, VOLUME_WINDOW)
+
+def required_bars(output_rows=OUTPUT_ROWS, names=None):
+    """出力本数 + 最も長い指標の助走期間 (依存グラフから求める) = 取得・計算に必要な本数"""
+    return output_rows + indicator_graph().lookback(names) - 1
+
+def fetch_window_start(bars=None, today=None):
+    """
+    ストアが空の場合の取得開始日: 今日 (today) から取引日を bars (+ 余裕) 本さかのぼった日
+    記録を再生する場合は today に記録の最終日 (provider.latest_date) を渡す (実行日によって本数が変わらないようにする)
+    取引日の暦 (trading_calendar) に無い臨時休場があっても足りるよう、
+    1年 = TRADING_DAYS_PER_YEAR 取引日として暦日に換算した日の方が早ければそちらを使う
+    """
+    bars = (bars or required_bars()) + FETCH_MARGIN_BARS
+    today = today or datetime.datetime.now(JST).date()
+    by_calendar = trading_calendar.sessions_back(today, bars)
+    by_days = today - datetime.timedelta(days=-(-bars * 365 // TRADING_DAYS_PER_YEAR))
+    return pd.Timestamp(min(by_calendar, by_days))
+
+def plan_fetch_start(stored, window_start=None, fetched_from=None):
+    """
+    差分取得の開始日を決める。None = 全期間取得
+    ストアが無い・重複期間を取れないほど短い場合は全期間取得する
+    計算に必要な本数に足りないストアも全期間を取り直すが、ストアが既に取得期間 (window_start 以降) を
+    覆っている場合 (上場が新しいなど、取得元にそれ以上の足が無い場合) は差分取得にする
+    fetched_from: ストアを作った全期間取得で要求した開始日 (price_store.load_fetched_from)
+    """
+    if stored is None or len(stored) <= STORE_OVERLAP_BARS:
+        return None
+    if len(stored) < required_bars():
+        window_start = window_start if window_start is not None else fetch_window_start()
+        covered = stored.index[0] <= window_start or (fetched_from is not None and fetched_from <= window_start)
+        if not covered:
+            return None
+    return stored.index[-STORE_OVERLAP_BARS]
+
+def apply_fetched(ticker, stored, fetched):
+    """
+    差分取得の結果を保存済みデータにマージする
+    重複期間で過去データの修正 (配当調整など) を検出した場合は None を返す (必要な期間の再取得が必要)
+    """
+    fetched = price_store.normalize_ohlcv(fetched)
+    overlap = stored.iloc[-STORE_OVERLAP_BARS:]
+
+    if fetched.empty:
+        print(f"差分取得が空でした。保存済みデータを使用します: {ticker}")
+        return stored
+    # 最終行は取得時点で確定前だった可能性があるため比較から除外する
+    if price_store.is_restated(overlap.iloc[:-1], fetched):
+        print(f"過去データの修正を検出しました。全期間を再取得します: {ticker}")
+        return None
+    return price_store.merge_prices(stored, fetched)
+
+def finalize_history(ticker, hist, store_dir=None, fetched_from=None):
+    """
+    ストアへ保存する
+    指標計算の本数 (required_bars) には絞らない。欠けた足などで出力行が足りない場合に計算側でさかのぼれるようにする
+    fetched_from: 全期間取得の場合に要求した開始日 (次回の plan_fetch_start で使う)
+    """
+    hist = price_store.normalize_ohlcv(hist)
+    if hist.empty:
+        return hist
+
+    price_store.save_prices(ticker, hist, store_dir, fetched_from=fetched_from)
+    return hist
+
+def widen_window(complete_rows, bars, available):
+    """
+    直近 bars 本で計算して NaN の無い行が OUTPUT_ROWS 本に足りなければ、足りない分だけ広げた本数を返す
+    (途中の欠けた足や、横ばいで RSI などが 0/0 になる期間の分をさかのぼる)
+    足りている・これ以上さかのぼれない場合は None
+    """
+    if complete_rows >= OUTPUT_ROWS or bars >= available:
+        return None
+    return min(available, bars + OUTPUT_ROWS - complete_rows)
+
+def fetch_history(ticker, store_dir=None, provider=None):
+    """
+    ローカルストアを使って差分取得する
+    保存済みの最終日付付近から取得し、重複期間が一致すればマージ、
+    過去データの修正 (配当調整など) を検出した場合は全期間を取り直す
+    """
+    provider = providers.as_provider(provider or DEFAULT_PROVIDER)
+    stored = price_store.load_prices(ticker, store_dir)
+    window_start = fetch_window_start(today=provider.latest_date(ticker))
+
+    hist = None
+    fetched_from = None
+    start = plan_fetch_start(stored, window_start, price_store.load_fetched_from(ticker, store_dir))
+    if start is not None:
+        fetched = provider.history(ticker, start=start)
+        hist = apply_fetched(ticker, stored, fetched)
+
+    if hist is None:
+        hist = provider.history(ticker, start=window_start)
+        fetched_from = window_start
+
+    return finalize_history(ticker, hist, store_dir, fetched_from=fetched_from)
+
+def fetch_histories_batched(tickers, batch_size=BATCH_SIZE, store_dir=None, provider=None, deadline=None):
+    """
+    ティッカーリストを batch_size 件ずつの一括リクエストで取得する
+    ストアがあるティッカーはグループ内の最も古い開始日から差分取得し、
+    ストアが無い・修正を検出したティッカーは全期間をまとめて取得する
+    取得できなかったティッカーは結果に含めない (実行期限を過ぎた場合は残りのグループを取得しない)
+    """
+    provider = providers.as_provider(provider or DEFAULT_PROVIDER)
+    deadline = deadline or Deadline(None)
+    stored = {t: price_store.load_prices(t, store_dir) for t in tickers}
+    window_starts = {t: fetch_window_start(today=provider.latest_date(t)) for t in tickers}
+    starts = {
+        t: plan_fetch_start(stored[t], window_starts[t], price_store.load_fetched_from(t, store_dir))
+        for t in tickers
+    }
+
+    histories = {}
+    fetched_from = {}
+    full_fetch = [t for t in tickers if starts[t] is None]
+    incremental = [t for t in tickers if starts[t] is not None]
+
+    for i in range(0, len(incremental), batch_size):
+        chunk = incremental[i:i + batch_size]
+        if deadline.expired():
+            break
+        try:
+            frames = provider.download(chunk, start=min(starts[t] for t in chunk))
+        except Exception as e:
+            print(f"一括取得エラー {chunk}: {e}")
+            continue
+        for t in chunk:
+            if t not in frames:
+                continue
+            hist = apply_fetched(t, stored[t], frames[t])
+            if hist is None:
+                full_fetch.append(t)
+            else:
+                histories[t] = hist
+
+    for i in range(0, len(full_fetch), batch_size):
+        chunk = full_fetch[i:i + batch_size]
+        if deadline.expired():
+            break
+        try:
+            window_start = min(window_starts[t] for t in chunk)
+            frames = provider.download(chunk, start=window_start)
+        except Exception as e:
+            print(f"一括取得エラー {chunk}: {e}")
+            continue
+        histories.update(frames)
+        fetched_from.update({t: window_start for t in frames})
+
+    results = {}
+    for t, hist in histories.items():
+        hist = finalize_history(t, hist, store_dir, fetched_from=fetched_from.get(t))
+        if not hist.empty:
+            results[t] = hist
+    return results
+
+# 出力の列: (列名, 指標の列, 小数点以下の桁数)
+OUTPUT_FIELDS = [
+    ("現在値", "Close", 1),
+    ("前日比(%)", "change_pct", 2),
+    ("短期(5日乖離)", "diff_short", 2),
+    ("中期(25日乖離)", "diff_mid", 2),
+    ("長期(75日乖離)", "diff_long", 2),
+    ("RSI", "rsi", 1),
+    ("BB%B(過熱)", "bb_pct_b", 2),
+    ("出来高倍率", "vol_ratio", 2),
+]
+
+# 出力に使う指標 (依存グラフの出力名)
+OUTPUT_INDICATORS = [column for _, column, _ in OUTPUT_FIELDS if column not in indicators.PANEL_COLUMNS]
+
+def make_row(code, name, date, values, updated_at):
+    """出力1行分の辞書を作る (values は OUTPUT_FIELDS の順に丸め済みの値)"""
+    row = {"コード": code, "セクター名": name, "日付": date}
+    for (field, _, _), value in zip(OUTPUT_FIELDS, values):
+        row[field] = value
+    row["更新日時"] = updated_at
+    return row
+
+def get_sector_data(code, name, hist=None, provider=None, lean=False, dtype=None):
     """
     指定銘柄のデータを取得・計算し、辞書のリストとして返す
+    hist が渡された場合 (一括取得済み) は取得を省略する
+    provider にリストを渡すと優先順のフェイルオーバーで取得する
+    lean / dtype は calculate_technical_indicators の省メモリ指定
     """
     ticker = f"{code}.T"
     try:
-        stock = yf.Ticker(ticker)
-        # 過去2年分取得
-        hist = stock.history(period="2y")
+        # 出力本数 + 指標の助走期間 (ストアがあれば差分のみ) 取得
+        if hist is None:
+            hist = fetch_history(ticker, provider=provider)
         
         if hist.empty:
             return []
 
-        # 指標計算
-        df = calculate_technical_indicators(hist)
+        # 指標計算 (必要な本数だけを計算し、NaN の行で出力行が足りなければその分さかのぼる)
+        bars = required_bars()
+        while bars is not None:
+            df = calculate_technical_indicators(hist.tail(bars), lean=lean, dtype=dtype).dropna()
+            bars = widen_window(len(df), bars, len(hist))
         
-        # NaNを除去し、直近1年(250営業日)分に絞る
-        df = df.dropna().tail(250) 
-
-        # 行データ作成用ヘルパー関数 (辞書型を返す)
-        def make_row(date_idx, row):
-            return {
-                "コード": code,
-                "セクター名": name,
-                "日付": date_idx.strftime('%Y-%m-%d'),
-                "現在値": round(row['Close'], 1),
-                "前日比(%)": round(row['change_pct'], 2),
-                "短期(5日乖離)": round(row['diff_short'], 2),
-                "中期(25日乖離)": round(row['diff_mid'], 2),
-                "長期(75日乖離)": round(row['diff_long'], 2),
-                "RSI": round(row['rsi'], 1),
-                "BB%B(過熱)": round(row['bb_pct_b'], 2),
-                "出来高倍率": round(row['vol_ratio'], 2),
-                "更新日時": datetime.datetime.now().strftime('%Y-%m-%d %H:%M')
-            }
+        # NaN (助走期間) を除去し、直近1年(250営業日)分に絞る
+        df = df.tail(OUTPUT_ROWS) 
 
         results = []
+        updated_at = datetime.datetime.now().strftime('%Y-%m-%d %H:%M')
         # 過去すべての行をリスト化 (日付の新しい順)
         for date_idx, row in df.iloc[::-1].iterrows():
-            results.append(make_row(date_idx, row))
+            values = [round(np.float64(row[column]), digits) for _, column, digits in OUTPUT_FIELDS]
+            results.append(make_row(code, name, date_idx.strftime('%Y-%m-%d'), values, updated_at))
             
         return results
 
@@ -112,26 +409,1100 @@ def get_sector_data(code, name):
         print(f"Error {code}: {e}")
         return []
 
-def main():
+def panel_values(histories, names=None, lean=False, dtype=None, workers=1, rows=None):
+    """
+    全銘柄の指標をパネル (本数 × 銘柄の2次元配列) でまとめて計算する
+    names を指定した場合はその指標 (と必要な中間値) だけを計算する
+    lean=True の場合は指標の計算に使う列 (終値・出来高) だけを配列にする。dtype を指定すると指標をその型で持つ
+    workers が2以上 (0 = CPUコア数) の場合は銘柄を分けてプロセスプールで計算する (価格は共有メモリで渡す)
+    rows は計算する直近の本数 (省略時は required_bars)
+    戻り値: (コードのリスト, 銘柄ごとの日付インデックス, {列名: 配列}, 出力対象の行 (本数 × 銘柄))
+    """
+    names = names or OUTPUT_INDICATORS
+    graph = indicator_graph()
+    rows = rows or required_bars(names=names)
+    columns = None
+    if lean or dtype is not None:
+        columns = sorted(set(graph.inputs(names)) | {c for _, c, _ in OUTPUT_FIELDS if c in indicators.PANEL_COLUMNS},
+                         key=indicators.PANEL_COLUMNS.index)
+    codes, indexes, arrays, present = indicators.stack_frames(histories, rows, columns)
+    if workers == 1:
+        values = graph.compute_panel(arrays, present, names, dtype=dtype)
+    else:
+        values = indicators.compute_panel_parallel(graph, arrays, present, names, workers or None, dtype=dtype)
+    values.update(arrays)
+
+    # dropna と同じく、OHLCV・指標のどれかが NaN の行を除く (配列にしなかった列も NaN の行は除く)
+    complete = present.copy()
+    for array in values.values():
+        complete &= ~np.isnan(array)
+    if columns is not None:
+        unused = [col for col in indicators.PANEL_COLUMNS if col not in columns]
+        complete &= ~indicators.incomplete_rows(histories, codes, rows, unused)
+    return codes, indexes, values, complete
+
+def get_panel_data(histories, universe, lean=False, dtype=None, workers=1):
+    """
+    全銘柄の指標をパネルでまとめて計算し、{コード: 辞書のリスト} を返す
+    histories: {コード: OHLCVデータフレーム}。結果は get_sector_data と同じ
+    """
+    return compute_panel_rows(histories, universe, lean=lean, dtype=dtype, workers=workers)[0]
+
+def compute_panel_rows(histories, universe, lean=False, dtype=None, workers=1):
+    """
+    get_panel_data の本体。({コード: 辞書のリスト}, {コード: 計算に使った直近の本数}) を返す
+    NaN の行で出力行が OUTPUT_ROWS に足りない銘柄は、get_sector_data と同じ本数だけさかのぼって計算し直す
+    """
+    frames = {code: hist for code, hist in histories.items() if not hist.empty}
+    results, windows = {}, {}
+    pending = {required_bars(): frames} if frames else {}
+    while pending:
+        bars, group = pending.popitem()
+        codes, indexes, values, complete = panel_values(group, lean=lean, dtype=dtype, workers=workers, rows=bars)
+
+        # 丸めは列ごとにまとめて行う (np.round は np.float64 の round() と同じ結果)
+        rounded = [np.round(np.asarray(values[column], dtype=np.float64), digits) for _, column, digits in OUTPUT_FIELDS]
+        updated_at = datetime.datetime.now().strftime('%Y-%m-%d %H:%M')
+        rows = len(complete)
+        for j, code in enumerate(codes):
+            windows[code] = min(bars, len(group[code]))
+            wider = widen_window(int(complete[:, j].sum()), bars, len(group[code]))
+            if wider is not None:
+                pending.setdefault(wider, {})[code] = group[code]
+                continue
+            # 日付の新しい順
+            positions = np.flatnonzero(complete[:, j])[-OUTPUT_ROWS:][::-1]
+            if len(positions) == 0:
+                continue
+            dates = indexes[j][positions - (rows - len(indexes[j]))].strftime('%Y-%m-%d')
+            columns = [array[positions, j].tolist() for array in rounded]
+            results[code] = [
+                make_row(code, universe[code], date, values, updated_at)
+                for date, values in zip(dates, zip(*columns))
+            ]
+    return {code: results[code] for code in frames if code in results}, windows
+
+def get_latest_data(histories, universe):
+    """
+    最新の足の行だけを計算し、{コード: [1行]} を返す (パネルの日中更新用)
+    各銘柄の末尾 (最も長い指標の窓の分) だけを使う。最新の足で値が揃わない銘柄は含めない
+    値は全期間を計算した場合と丸め後で一致する (窓の外からの累積誤差が無い分、最終桁がまれに変わる)
+    """
+    frames = {code: hist for code, hist in histories.items() if not hist.empty}
+    if not frames:
+        return {}
+    graph = indicator_graph()
+    codes, indexes, arrays, present = indicators.stack_frames(frames, graph.lookback(OUTPUT_INDICATORS))
+    values = graph.compute_latest(arrays, present, OUTPUT_INDICATORS)
+    values.update({column: array[-1] for column, array in arrays.items()})
+
+    complete = present[-1].copy()
+    for array in values.values():
+        complete &= ~np.isnan(array)
+    rounded = [np.round(values[column], digits) for _, column, digits in OUTPUT_FIELDS]
+    updated_at = datetime.datetime.now().strftime('%Y-%m-%d %H:%M')
+    results = {}
+    for j, code in enumerate(codes):
+        if complete[j]:
+            date = indexes[j][-1].strftime('%Y-%m-%d')
+            results[code] = [make_row(code, universe[code], date, [float(array[j]) for array in rounded], updated_at)]
+    return results
+
+def verify_backends(histories):
+    """
+    使用できる全ての計算カーネル (indicators.available_backends) でパネル計算を行い、
+    銘柄ごとの pandas 計算 (calculate_technical_indicators) と指標の値をビット単位で照合する
+    戻り値: {カーネル名: {"seconds": 計算時間, "mismatches": ["コード:指標", ...]}}
+    """
+    frames = {code: hist for code, hist in histories.items() if not hist.empty}
+    reference = {code: calculate_technical_indicators(hist.tail(required_bars())) for code, hist in frames.items()}
+    current = indicators.get_backend()
+    report = {}
+    try:
+        for backend in indicators.available_backends():
+            indicators.set_backend(backend)
+            started = time.perf_counter()
+            codes, _, values, _ = panel_values(frames)
+            elapsed = time.perf_counter() - started
+            mismatches = []
+            for j, code in enumerate(codes):
+                expected = reference[code]
+                for column in OUTPUT_INDICATORS:
+                    actual = values[column][len(values[column]) - len(expected):, j]
+                    if not np.array_equal(actual, expected[column].to_numpy(dtype=float), equal_nan=True):
+                        mismatches.append(f"{code}:{column}")
+            report[backend] = {"seconds": round(elapsed, 3), "mismatches": mismatches}
+    finally:
+        indicators.set_backend(current)
+    return report
+
+def build_stream(hist):
+    """保存済みの足を先頭から積み上げて逐次計算の状態を作る (パネル計算と同じ足から始める)"""
+    stream = indicator_graph().stream(names=OUTPUT_INDICATORS)
+    for date_idx, bar in zip(hist.index, hist[indicators.PANEL_COLUMNS].to_dict('records')):
+        stream.push(date_idx.strftime('%Y-%m-%d'), {k: float(v) for k, v in bar.items()})
+    return stream
+
+def stream_rebuild_reason(state, hist, previous, graph):
+    """
+    逐次計算の状態をそのまま使えない理由を返す (使える場合は None)
+    状態が無い・指標の設定が変わった・前回の出力と食い違う・過去データが修正された場合は作り直す
+    """
+    if not state:
+        return "状態なし"
+    if state.get("graph") != graph.signature():
+        return "指標の設定が変更"
+    last_date = state.get("last_date")
+    if not previous or previous[0]['日付'] != last_date:
+        return "前回の出力と不一致"
+    known = hist[hist.index <= pd.Timestamp(last_date)]
+    if known.empty or known.index[-1] != pd.Timestamp(last_date):
+        return "保存済みデータに最終日がない"
+
+    # 差分取得の重複期間と同じ許容差で比べる (取り直した足の末尾桁の揺れは修正とみなさない)
+    recent = graph.stream(state, OUTPUT_INDICATORS).recent()
+    for column, values in recent.items():
+        stored = known[column].to_numpy(dtype=float)[-len(values):]
+        if len(stored) != len(values) or not np.isclose(
+            stored, np.array(values, dtype=float), rtol=1e-6, atol=1e-9, equal_nan=True
+        ).all():
+            return "過去データが修正された"
+    return None
+
+def stream_sector_data(histories, universe, previous_rows, states, verify=False):
+    """
+    逐次計算で指標を更新し、({コード: 辞書のリスト}, 新しい状態, 統計) を返す
+    前回の出力の後に増えた足だけを状態に追加して計算し (1本あたり O(1))、前回の出力行の先頭に足す
+    作り直しが必要な銘柄と、verify=True (または前回の照合から STREAM_VERIFY_EVERY 回目) の銘柄は
+    パネル計算で全期間を計算し直す。照合時は逐次計算の結果と比べ、一致しなければ記録する
+    """
+    graph = indicator_graph()
+    updated_at = datetime.datetime.now().strftime('%Y-%m-%d %H:%M')
+    rows_by_code, new_states = {}, {}
+    stats = {"appended": 0, "rebuilt": {}, "verified": [], "mismatches": []}
+    rebuild, streamed = {}, {}
+
+    for code, hist in histories.items():
+        if hist.empty:
+            continue
+        state = states.get(code)
+        reason = stream_rebuild_reason(state, hist, previous_rows.get(code), graph)
+        if reason:
+            rebuild[code] = hist
+            stats["rebuilt"][code] = reason
+            continue
+
+        stream = graph.stream(state, OUTPUT_INDICATORS)
+        new = hist[hist.index > pd.Timestamp(stream.last_date)]
+        rows = []
+        for date_idx, bar in zip(new.index, new[indicators.PANEL_COLUMNS].to_dict('records')):
+            date = date_idx.strftime('%Y-%m-%d')
+            out = stream.push(date, {k: float(v) for k, v in bar.items()})
+            if any(v != v for v in out.values()):
+                continue
+            values = [round(np.float64(out[column]), digits) for _, column, digits in OUTPUT_FIELDS]
+            rows.append(make_row(code, universe[code], date, values, updated_at))
+        stats["appended"] += len(rows)
+
+        rows = rows[::-1] + [dict(row, 更新日時=updated_at) for row in previous_rows[code]]
+        rows_by_code[code] = rows[:OUTPUT_ROWS]
+        runs = state.get("runs_since_verify", 0) + 1
+        if verify or runs >= STREAM_VERIFY_EVERY:
+            rebuild[code] = hist
+            streamed[code] = rows_by_code[code]
+        else:
+            new_states[code] = dict(stream.to_dict(), runs_since_verify=runs)
+
+    # --- 作り直し・照合: パネル計算で全期間を計算し、状態を積み上げ直す ---
+    if rebuild:
+        rebuilt, windows = compute_panel_rows(rebuild, universe)
+        for code, rows in rebuilt.items():
+            rows_by_code[code] = rows
+            # 状態はパネル計算と同じ足 (さかのぼった場合はその分も含む) から積み上げる
+            new_states[code] = dict(build_stream(rebuild[code].tail(windows[code])).to_dict(), runs_since_verify=0)
+            if code not in streamed:
+                continue
+            stats["verified"].append(code)
+            strip = lambda rs: [{k: v for k, v in r.items() if k != '更新日時'} for r in rs]
+            for got, want in zip(strip(streamed[code]), strip(rows)):
+                if got != want:
+                    stats["mismatches"].append({"code": code, "streamed": got, "recomputed": want})
+                    break
+            else:
+                if len(streamed[code]) != len(rows):
+                    stats["mismatches"].append({"code": code, "streamed": len(streamed[code]),
+                                                "recomputed": len(rows)})
+    return rows_by_code, new_states, stats
+
+def compute_per_ticker(histories, tickers, universe, deadline, lean=False, dtype=None):
+    """
+    銘柄ごとに get_sector_data を並列実行する (パネル計算を使わない場合)
+    期限までに終わらなかった銘柄はキャンセルし、結果に含めない (前回の出力で補う)
+    """
+    rows_by_code = {}
+    executor = ThreadPoolExecutor(max_workers=5)
+    futures = {
+        executor.submit(get_sector_data, code, universe[code], histories[ticker], lean=lean, dtype=dtype): code
+        for ticker, code in tickers.items() if ticker in histories
+    }
+    done, not_done = wait(futures, timeout=deadline.remaining())
+    # 未着手の計算は取り消し、実行中のものの終了は待たない
+    executor.shutdown(wait=False, cancel_futures=True)
+    if not_done:
+        print(f"警告: 実行期限のため {len(not_done)}銘柄の指標計算を打ち切りました")
+    for future in done:
+        res = future.result()
+        if res:
+            rows_by_code[futures[future]] = res
+    return rows_by_code
+
+def compute_rows(code, name, hist, engine="panel", lean=False, dtype=None):
+    """1銘柄分の出力行を計算する (engine: panel = パネル計算を1銘柄で, frame = pandas)"""
+    if engine == "panel":
+        return get_panel_data({code: hist}, {code: name}, lean=lean, dtype=dtype).get(code, [])
+    return get_sector_data(code, name, hist, lean=lean, dtype=dtype)
+
+def render_row(row):
+    """出力ファイル (インデント2のJSON配列) の要素1つ分の文字列"""
+    return "  " + json.dumps(row, ensure_ascii=False, indent=2).replace("\n", "\n  ")
+
+def write_rows(rows, f, rendered=None):
+    """
+    json.dump(list(rows), f, ensure_ascii=False, indent=2) と同じ内容を書く
+    rows はイテレータでもよい (1行ずつ書くため全行をリストにしない)
+    rendered ({(コード, 日付): 文字列}) にある行は JSON化済みの文字列をそのまま使う
+    戻り値: 書いた行数
+    """
+    rendered = rendered or {}
+    count = 0
+    for row in rows:
+        f.write("[\n" if count == 0 else ",\n")
+        f.write(rendered.get((row['コード'], row['日付'])) or render_row(row))
+        count += 1
+    f.write("[]" if count == 0 else "\n]")
+    return count
+
+class ComputePipeline:
+    """
+    取得が終わった銘柄から順に、指標計算と出力行のJSON化をスレッドプールで進める (--pipeline)
+    取得の完了順に submit() し、全銘柄の取得後に collect() で結果を受け取る
+    計算と書き出しの準備が残りの取得と重なるため、全体の時間は最も遅い取得に近づく
+    """
+
+    def __init__(self, tickers, universe, engine="panel", lean=False, dtype=None, workers=PIPELINE_WORKERS):
+        self.tickers = tickers
+        self.universe = universe
+        self.engine = engine
+        self.lean = lean
+        self.dtype = dtype
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.futures = {}
+        self.started = time.monotonic()
+        self.first_done = None
+
+    def _run(self, code, hist):
+        rows = compute_rows(code, self.universe[code], hist, self.engine, self.lean, self.dtype)
+        if self.first_done is None:
+            self.first_done = time.monotonic() - self.started
+        return rows, {(row['コード'], row['日付']): render_row(row) for row in rows}
+
+    def submit(self, ticker, hist):
+        """取得できた銘柄の計算を始める (同じ銘柄を再度渡した場合は後の方を使う)"""
+        code = self.tickers[ticker]
+        if hist is None or hist.empty:
+            return
+        self.futures[code] = self.executor.submit(self._run, code, hist)
+
+    def collect(self, deadline):
+        """
+        計算結果を待って ({コード: 行のリスト}, {(コード, 日付): JSON文字列}) を返す
+        期限までに終わらなかった銘柄は含めない (前回の出力で補う)
+        """
+        done, not_done = wait(self.futures.values(), timeout=deadline.remaining())
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        if not_done:
+            print(f"警告: 実行期限のため {len(not_done)}銘柄の指標計算を打ち切りました")
+        rows_by_code, rendered = {}, {}
+        for code, future in self.futures.items():
+            if future not in done:
+                continue
+            try:
+                rows, texts = future.result()
+            except Exception as e:
+                print(f"Error {code}: {e}")
+                continue
+            if rows:
+                rows_by_code[code] = rows
+                rendered.update(texts)
+        return rows_by_code, rendered
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="TOPIX-17業種ETFのテクニカル指標を計算する")
+    parser.add_argument(
+        "--batch-size", type=int, default=BATCH_SIZE,
+        help="一括取得の1リクエストあたりのティッカー数 (0 = 銘柄ごとに取得)"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=fetch_engine.DEFAULT_CONCURRENCY,
+        help="個別取得の同時実行数 (適応制御の初期値)"
+    )
+    parser.add_argument(
+        "--max-concurrency", type=int, default=fetch_engine.AIMD_MAX_CONCURRENCY,
+        help="適応制御で上げられる同時実行数の上限"
+    )
+    parser.add_argument(
+        "--fixed-concurrency", action="store_true",
+        help="同時実行数の適応制御 (AIMD) を無効にし、--concurrency で固定する"
+    )
+    parser.add_argument(
+        "--rate", type=float, default=fetch_engine.DEFAULT_RATE,
+        help="全体のリクエスト速度の上限 (件/秒)"
+    )
+    parser.add_argument(
+        "--max-retries", type=int, default=fetch_engine.DEFAULT_MAX_RETRIES,
+        help="タイムアウト・429・5xx 時の再試行回数"
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=fetch_engine.DEFAULT_TIMEOUT,
+        help="1リクエストあたりのタイムアウト (秒)"
+    )
+    parser.add_argument(
+        "--on-missing", choices=["fail", "last-good", "stale"], default=MISSING_POLICY,
+        help="取得失敗時の扱い (fail = 出力せず異常終了, last-good = 保存済みデータで補う, "
+             "stale = 保存済みデータで補い未更新と明示する)"
+    )
+    parser.add_argument(
+        "--resume", action="store_true",
+        help="当日の取得台帳で失敗・欠損となっている銘柄だけを取り直し、既存の出力にマージする"
+    )
+    parser.add_argument(
+        "--wait-for-close", action="store_true",
+        help="大引け後、当日の足が全銘柄に出るまで軽い確認を繰り返し、出た時点で取得を始める"
+    )
+    parser.add_argument(
+        "--deadline", type=float, default=None,
+        help=f"実行全体の期限 (今から何秒後)。環境変数 {RUN_DEADLINE_ENV} (UNIX時刻) があればそちらを優先する"
+    )
+    parser.add_argument(
+        "--publish-reserve", type=float, default=PUBLISH_RESERVE,
+        help="期限のうち投稿のために残しておく時間 (秒)"
+    )
+    parser.add_argument(
+        "--compute-reserve", type=float, default=COMPUTE_RESERVE,
+        help="期限のうち指標計算・保存のために残しておく時間 (秒)"
+    )
+    parser.add_argument(
+        "--engine", choices=["panel", "frame", "stream"], default="panel",
+        help="指標計算の方式 (panel = 全銘柄を2次元配列でまとめて計算, frame = 銘柄ごとにpandasで計算, "
+             "stream = 前回からの状態に新しい足だけを追加して計算)"
+    )
+    parser.add_argument("--output", default=OUTPUT_FILE, help="出力の保存先")
+    parser.add_argument("--meta-output", default=METADATA_FILE, help="実行メタデータの保存先")
+    parser.add_argument(
+        "--previous-output", default=None,
+        help="取得できなかった銘柄の補完・逐次計算に使う前回の出力 (既定: --output と同じ)"
+    )
+    parser.add_argument("--codes", default=None, help="対象をこのコードに絞る (カンマ区切り)")
+    parser.add_argument(
+        "--shard-plan", type=int, default=0,
+        help="銘柄をN個のシャードに分けて --queue-dir のキューに登録する (前回の計画・部分結果は消す)"
+    )
+    parser.add_argument(
+        "--shard-worker", action="store_true",
+        help="キューからシャードを取り出して処理する (キューが空になるまで。複数のワーカーを同時に動かせる)"
+    )
+    parser.add_argument(
+        "--shard-args", default="",
+        help="--shard-worker がシャードごとに起動する sector_analysis.py へ渡す引数 (例: '--engine panel')"
+    )
+    parser.add_argument(
+        "--shard-merge", action="store_true",
+        help="処理済みシャードの部分結果を k-way マージして --output / --meta-output に保存する"
+    )
+    parser.add_argument("--queue-dir", default=SHARD_QUEUE_DIR, help="シャードのファイルキューの置き場所")
+    parser.add_argument(
+        "--compute-workers", type=int, default=1,
+        help="panel の計算に使うプロセス数 (0 = CPUコア数)。銘柄を分けて並列に計算し、価格は共有メモリで渡す"
+    )
+    parser.add_argument(
+        "--pipeline", action="store_true",
+        help="取得が終わった銘柄から順に指標計算・JSON化を進め、残りの取得と重ねる (panel / frame)"
+    )
+    parser.add_argument(
+        "--latest-only", action="store_true",
+        help="最新の足の行だけを計算して --output に対応する '{名前}_latest.json' (既定: sector_latest.json) に保存する "
+             "(パネルの日中更新用。sector_data.json などは更新しない)"
+    )
+    parser.add_argument(
+        "--lean", action="store_true",
+        help="省メモリで計算する (終値・出来高だけを使い、中間値を残さない。結果は同じ)"
+    )
+    parser.add_argument(
+        "--float32", action="store_true",
+        help="--lean に加えて指標を float32 で持つ (丸めた値が最終桁で変わる場合がある)"
+    )
+    parser.add_argument(
+        "--backend", choices=indicators.BACKENDS, default=None,
+        help="panel / stream の移動窓の計算カーネル (既定: numba があれば numba、無ければ numpy)"
+    )
+    parser.add_argument(
+        "--verify-backends", action="store_true",
+        help="使用できる全ての計算カーネルで計算し、銘柄ごとの pandas 計算と一致するか照合する"
+    )
+    parser.add_argument(
+        "--verify-stream", action="store_true",
+        help="stream の場合に全期間を計算し直して逐次計算の結果と照合する (状態も作り直す)"
+    )
+    parser.add_argument(
+        "--state-dir", default=None,
+        help=f"サーキット状態などの保存先 (既定: {FETCH_STATE_DIR}、再生時は {REPLAY_DIR}/ の下)"
+    )
+    parser.add_argument(
+        "--snapshot-dir", default=None,
+        help=f"最後に全セクターを正常に取得できた出力の保存先 (既定: {SNAPSHOT_DIR}、再生時は {REPLAY_DIR}/ の下)"
+    )
+    parser.add_argument(
+        "--hedge", action="store_true",
+        help="p90レイテンシを過ぎても終わらない要求に同じ要求を追加し、先に返った方を採用する"
+    )
+    parser.add_argument(
+        "--provider", default=os.environ.get("PRICE_PROVIDER", "yahoo"),
+        help="データ取得元 yahoo / record / replay / csv (record = Yahooの応答を記録, "
+             "replay = 記録をオフラインで再生, csv = ローカルCSV)。"
+             "'yahoo,csv' のようにカンマ区切りで優先順のフェイルオーバーになる"
+    )
+    parser.add_argument("--csv-dir", default=providers.CSV_DROP_DIR, help="csv取得元のCSVの置き場所")
+    parser.add_argument(
+        "--failover-timeout", type=float, default=providers.FAILOVER_TIMEOUT,
+        help="フェイルオーバー時に1つの取得元を待つ時間 (秒)"
+    )
+    parser.add_argument(
+        "--race", action="store_true",
+        help="フェイルオーバー時に全取得元へ同時に要求し、最初の応答を採用する (残りの応答で品質を検証)"
+    )
+    parser.add_argument(
+        "--cache", action="store_true",
+        help="取得元の応答をディスクにキャッシュする (次の大引けまで有効。同じ日の再実行で取得元へ問い合わせない)"
+    )
+    parser.add_argument("--cache-dir", default=providers.RESPONSE_CACHE_DIR, help="応答キャッシュの置き場所")
+    parser.add_argument(
+        "--cache-max-mb", type=float, default=providers.CACHE_MAX_MB,
+        help="応答キャッシュの上限サイズ (MB)。超えたら最後に使ってから長いものから削除する"
+    )
+    parser.add_argument("--record-dir", default=providers.RECORD_DIR, help="記録・再生ファイルの置き場所")
+    parser.add_argument(
+        "--store-dir", default=None,
+        help=f"株価ストアの置き場所 (既定: {price_store.PRICE_STORE_DIR}、再生時は {REPLAY_DIR}/ の下)"
+    )
+    parser.add_argument("--replay-latency", type=float, default=0.0, help="再生時に注入する遅延 (秒)")
+    parser.add_argument("--replay-jitter", type=float, default=0.0, help="再生時の遅延のばらつき (秒)")
+    parser.add_argument("--replay-failure-rate", type=float, default=0.0, help="再生時に注入する障害の確率")
+    parser.add_argument("--replay-seed", type=int, default=0, help="遅延・障害注入の乱数シード")
+    parser.add_argument(
+        "--universe-size", type=int, default=len(SECTOR_ETFS),
+        help="対象銘柄数 (replay時のみ。17を超える分は記録済みデータから合成した銘柄を追加する)"
+    )
+    return resolve_dirs(parser.parse_args(argv))
+
+def resolve_dirs(args):
+    """
+    株価ストア・状態・スナップショットの置き場所の既定を決める (指定された場合はそのまま)
+    再生 (--provider に replay を含む) の場合は REPLAY_DIR の下を既定にし、本番用のストア・状態を書き換えない
+    """
+    replay = "replay" in args.provider.split(",")
+    for name, default in [("store_dir", price_store.PRICE_STORE_DIR), ("state_dir", FETCH_STATE_DIR),
+                          ("snapshot_dir", SNAPSHOT_DIR)]:
+        if getattr(args, name) is None:
+            if replay:
+                default = os.path.join(REPLAY_DIR, os.path.basename(os.path.normpath(default)))
+            setattr(args, name, default)
+    return args
+
+def build_universe(size=None):
+    """
+    対象銘柄 {コード: セクター名} を返す
+    size が17を超える場合は負荷試験用の合成銘柄を追加する (再生プロバイダでのみ取得可能)
+    """
+    universe = dict(SECTOR_ETFS)
+    for i in range(len(universe), size or 0):
+        universe[f"S{i:04d}"] = f"合成{i:04d}"
+    return universe
+
+def fetch_history_checked(ticker, provider=None, store_dir=None):
+    """取得エンジン用: 空データを再試行対象のエラーとして扱う"""
+    hist = fetch_history(ticker, store_dir=store_dir, provider=provider)
+    if hist.empty:
+        raise fetch_engine.EmptyResultError(f"{ticker}: データが空です")
+    return hist
+
+def fallback_histories(tickers, store_dir=None):
+    """
+    取得に失敗した銘柄について、ストアに残っている最後の正常データを返す
+    戻り値: {ticker: データフレーム} (ストアにも無い銘柄は含めない)
+    """
+    results = {}
+    for ticker in tickers:
+        stored = price_store.load_prices(ticker, store_dir)
+        if stored is None or stored.empty:
+            continue
+        results[ticker] = stored
+    return results
+
+def save_snapshot(output_file, meta_file=METADATA_FILE, snapshot_dir=SNAPSHOT_DIR):
+    """
+    全セクターを正常に取得できた出力を「最後の正常データ」として保存する
+    (wordpress_publisher.py の stale-while-revalidate で即時投稿に使う)
+    """
+    try:
+        os.makedirs(snapshot_dir, exist_ok=True)
+        for path in [output_file, meta_file]:
+            tmp_path = os.path.join(snapshot_dir, os.path.basename(path) + ".tmp")
+            shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, os.path.join(snapshot_dir, os.path.basename(path)))
+    except Exception as e:
+        print(f"スナップショット保存エラー: {e}")
+
+def peak_rss_mb():
+    """このプロセスのピーク常駐メモリ (MB)。取得できない環境では None"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KB、macOS はバイト単位
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def write_metadata(meta, path=METADATA_FILE):
+    """実行メタデータ (取得統計など) をJSONで保存する"""
+    try:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+    except Exception as e:
+        print(f"メタデータ保存エラー: {e}")
+
+def fetch_universe(tickers, args, provider, breakers, deadline, on_result=None):
+    """
+    一括取得 (有効な場合) と非同期エンジンによる個別取得を行う
+    on_result(ticker, データフレーム) は取得できた銘柄ごとに、取得できた時点で呼ぶ
+    戻り値: ({ticker: データフレーム}, 銘柄ごとの取得統計, エンジン全体の統計)
+    """
+    fetch_stats = {}
+
+    # --- 一括取得 (有効な場合) ---
+    histories = {}
+    if args.batch_size > 0:
+        histories = fetch_histories_batched(
+            list(tickers), args.batch_size, store_dir=args.store_dir, provider=provider,
+            deadline=deadline
+        )
+        print(f"一括取得完了: {len(histories)}/{len(tickers)}銘柄")
+        for ticker in histories:
+            fetch_stats[ticker] = {"status": "ok", "mode": "batch"}
+            if on_result:
+                on_result(ticker, histories[ticker])
+
+    # --- 個別取得 (非同期エンジン: 並行数制限・レート制限・再試行) ---
+    # 一括取得で取れなかった銘柄もここで取得し直す
+    remaining = [t for t in tickers if t not in histories]
+    summary = None
+    if remaining:
+        fetched, engine = fetch_engine.fetch_all(
+            remaining, partial(fetch_history_checked, provider=provider, store_dir=args.store_dir),
+            concurrency=args.concurrency, rate=args.rate,
+            max_retries=args.max_retries, timeout=args.timeout, hedge=args.hedge,
+            adaptive=not args.fixed_concurrency, max_concurrency=args.max_concurrency,
+            breakers=breakers, deadline=deadline, on_result=on_result,
+            hedge_fn=partial(
+                fetch_history_checked, provider=providers.without_single_flight(provider),
+                store_dir=args.store_dir
+            )
+        )
+        histories.update(fetched)
+        fetch_stats.update(engine.stats)
+        summary = engine.summary()
+        print(
+            f"取得完了: {summary['ok']}/{summary['requested']}銘柄 "
+            f"(試行 {summary['attempts']}回, p90 {summary['latency_p90']}秒, 全体 {summary['elapsed']}秒)"
+        )
+        concurrency = summary["concurrency"]
+        if concurrency["mode"] == "aimd":
+            print(f"同時実行数: 初期 {concurrency['initial']} → 最終 {concurrency['final']} (最大 {concurrency['max']})")
+        if summary["hedge"]:
+            hedge = summary["hedge"]
+            print(f"ヘッジ要求: {hedge['fired']}回 (勝ち {hedge['wins']}回, 短縮 {hedge['saved_total']}秒)")
+
+    return histories, fetch_stats, summary
+
+def today_jst():
+    """東証の営業日判定に使う日本時間の日付"""
+    return datetime.datetime.now(JST).strftime('%Y-%m-%d')
+
+def tickers_with_bar(tickers, day, provider, batch_size):
+    """
+    指定日の足がすでに出ている銘柄を返す (直近数日分だけを一括取得する軽い確認)
+    戻り値: {ticker: その足の OHLCV (配列)}。確認ごとの値を比べて足が確定したかを判定するのに使う
+    """
+    found = {}
+    batch_size = batch_size or len(tickers)
+    for i in range(0, len(tickers), batch_size):
+        chunk = tickers[i:i + batch_size]
+        try:
+            frames = provider.download(chunk, period=CLOSE_CHECK_PERIOD)
+        except Exception as e:
+            print(f"引け確認エラー {chunk}: {e}")
+            continue
+        for ticker, df in frames.items():
+            if not df.empty and df.index[-1].strftime('%Y-%m-%d') == day:
+                found[ticker] = df.iloc[-1].reindex(price_store.OHLCV_COLUMNS).to_numpy(dtype=float)
+    return found
+
+def wait_for_close(tickers, provider, deadline, batch_size=0, max_wait=CLOSE_MAX_WAIT,
+                   interval=CLOSE_POLL_INTERVAL, max_interval=CLOSE_POLL_MAX_INTERVAL):
+    """
+    大引け後、当日の足が全銘柄で確定するまでバックオフしながら確認する
+    取得元のデータは遅延するため、大引けから MARKET_DATA_DELAY 分が過ぎるまで待ち、
+    さらに当日の足の OHLCV が連続する2回の確認で変わらなかった銘柄だけを確定とみなす (途中経過の足を出さない)
+    戻り値: 全銘柄確定した・期限までに一部でも確定した場合 True、確定した当日の足が1本も無い場合 False
+    (出来高のない銘柄は当日の足が出ないことがあるため、一部確定した時点で期限が来れば先へ進む)
+    """
+    now = datetime.datetime.now(JST)
+    today = now.strftime('%Y-%m-%d')
+    if not trading_calendar.is_trading_day(now.date()):
+        print("本日は休場日 (土日・祝日・年末年始) です。")
+        return False
+
+    close_at = now.replace(hour=MARKET_CLOSE[0], minute=MARKET_CLOSE[1], second=0, microsecond=0)
+    settle_at = close_at + datetime.timedelta(minutes=MARKET_DATA_DELAY)
+    if now < settle_at:
+        wait_seconds = (settle_at - now).total_seconds()
+        print(f"大引け ({close_at.strftime('%H:%M')}) + データ遅延 {MARKET_DATA_DELAY}分 まで {wait_seconds:.0f}秒 待ちます...")
+        time.sleep(deadline.timeout(wait_seconds))
+
+    # 実行期限と最大待ち時間の早い方まで確認を続ける
+    limit = Deadline.after(max_wait)
+    if deadline.expires_at is not None and deadline.expires_at < limit.expires_at:
+        limit = deadline
+
+    pending = list(tickers)
+    found = set()
+    previous = {}
+    while True:
+        bars = tickers_with_bar(pending, today, provider, batch_size)
+        found |= {t for t, bar in bars.items() if t in previous and np.array_equal(previous[t], bar, equal_nan=True)}
+        previous = bars
+        pending = [t for t in tickers if t not in found]
+        print(f"引け確認: 当日 ({today}) の足 確定 {len(found)}/{len(tickers)}銘柄 (未確定の足 {len(bars) - len(found & set(bars))}銘柄)")
+        if not pending:
+            return True
+        if limit.timeout(interval) < interval:
+            break
+        time.sleep(interval)
+        interval = min(max_interval, interval * 1.5)
+
+    if found:
+        print(f"警告: 当日の足が確定していない銘柄があります ({', '.join(pending)})。確定した分で続行します。")
+        return True
+    return False
+
+def load_json(path, default=None):
+    """JSONファイルを読み込む。無い・壊れている場合は default を返す"""
+    if not os.path.exists(path):
+        return default
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"読み込みエラー {path}: {e}")
+        return default
+
+def latest_file(output_file):
+    """
+    --latest-only の出力先 (銘柄ごとの最新の足の1行): --output と同じ場所の '{名前}_latest.json'
+    名前が '_data' で終わる場合は置き換える (既定の sector_data.json なら sector_latest.json)
+    wordpress_publisher.latest_file と同じ規則
+    """
+    base, ext = os.path.splitext(output_file)
+    if base.endswith("_data"):
+        base = base[:-len("_data")]
+    return f"{base}_latest{ext}"
+
+def save_json(data, path, indent=2):
+    """JSONを保存する (一時ファイル経由で置き換え)"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent)
+    os.replace(tmp_path, path)
+
+def select_resume_targets(tickers, ledger, existing_codes):
+    """
+    再開時に取り直す銘柄を選ぶ: 台帳で fresh 以外 (失敗・補完) のもの、台帳に無いもの、出力に無いもの
+    """
+    entries = ledger.get("tickers", {})
+    return [
+        ticker for ticker, code in tickers.items()
+        if entries.get(ticker, {}).get("status") != "fresh" or code not in existing_codes
+    ]
+
+def plan_shards(universe, count, queue):
+    """銘柄をコード順に count 個の連続した範囲 (シャード) に分けてキューに入れる"""
+    codes = sorted(universe)
+    count = max(1, min(count, len(codes)))
+    queue.reset()
+    for i in range(count):
+        chunk = codes[i * len(codes) // count:(i + 1) * len(codes) // count]
+        queue.put(f"shard-{i:03d}", chunk)
+    print(f"シャード: {len(codes)}銘柄を {count}個に分けて '{queue.root}' に登録しました")
+
+def run_shard_worker(args):
+    """
+    キューからシャードを1つずつ取り出し、その銘柄だけで sector_analysis.py を別プロセスで実行する (キューが空になるまで)
+    部分結果はキューの results/ に書き、状態 (サーキット・逐次計算など) はシャードごとに分けて保存する
+    銘柄の集合・取得元の指定 (SHARD_FORWARD_ARGS) はワーカー自身の指定を引き継ぐ
+    失敗したシャードは未処理に戻す (他のワーカーが取り直す)
+    戻り値: 失敗したシャードの数
+    """
+    queue = shard_queue.ShardQueue(args.queue_dir)
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    script = os.path.abspath(__file__)
+    forwarded = []
+    for name in SHARD_FORWARD_ARGS:
+        forwarded += [f"--{name.replace('_', '-')}", str(getattr(args, name))]
+    failures = 0
+    while True:
+        requeued = queue.requeue_stale()
+        if requeued:
+            print(f"シャード: 処理が止まっていたシャードを未処理に戻しました ({', '.join(requeued)})")
+        shard = queue.claim(worker)
+        if shard is None:
+            break
+        data_path, meta_path = queue.result_paths(shard["id"])
+        print(f"シャード {shard['id']}: {len(shard['codes'])}銘柄を処理します ({shard['attempts']}回目)")
+        returncode = subprocess.call([
+            sys.executable, script, *forwarded, *shlex.split(args.shard_args),
+            "--codes", ",".join(shard["codes"]), "--output", data_path, "--meta-output", meta_path,
+            "--previous-output", args.output, "--state-dir", os.path.join(args.state_dir, "shards", shard["id"]),
+        ])
+        if returncode == 0:
+            if not queue.complete(shard):
+                print(f"警告: シャード {shard['id']} は処理中に未処理に戻されたため、完了として記録しません")
+        else:
+            failures += 1
+            state = queue.fail(shard, f"終了コード {returncode}")
+            if state is None:
+                print(f"警告: シャード {shard['id']} の処理に失敗しました (終了コード {returncode}, 処理中に未処理に戻されています)")
+            else:
+                print(f"警告: シャード {shard['id']} の処理に失敗しました (終了コード {returncode}, {state} に移しました)")
+    print(f"シャード: 処理待ちがなくなりました (状態: {queue.counts()})")
+    return failures
+
+def merge_shards(queue, universe, output_file=OUTPUT_FILE, meta_file=METADATA_FILE, on_missing=MISSING_POLICY,
+                 snapshot_dir=SNAPSHOT_DIR):
+    """
+    処理済みシャードの部分結果を k-way マージして1つの出力にまとめる
+    部分結果はどれも (日付, コード) の新しい順に並んでいるため、heapq.merge で全体を並べ替えずに1行ずつ書き出す
+    終わっていないシャードの銘柄は前回の出力の行で補う (on_missing が fail の場合は出力せずに終了する)
+    戻り値: 全シャードが揃い、欠損・未更新が無い場合 True
+    """
+    done = queue.list("done")
+    unfinished = [shard for state in ("pending", "claimed", "failed") for shard in queue.list(state)]
+    if unfinished:
+        print(f"警告: 終わっていないシャードがあります ({', '.join(shard['id'] for shard in unfinished)})")
+        if on_missing == "fail":
+            print("エラー: 終わっていないシャードがあるため、出力せずに終了します")
+            exit(1)
+
+    sources, sectors, shard_stats, failed = [], {}, {}, []
+    partial = bool(unfinished)
+    for shard in done:
+        data_path, meta_path = queue.result_paths(shard["id"])
+        sources.append(load_json(data_path, []))
+        meta = load_json(meta_path, {})
+        sectors.update(meta.get("sectors", {}))
+        partial = partial or meta.get("partial", False)
+        fetch = meta.get("fetch") or {}
+        failed.extend(fetch.get("failed") or [])
+        shard_stats[shard["id"]] = {
+            "codes": len(shard["codes"]), "worker": shard.get("worker"), "attempts": shard.get("attempts"),
+            "elapsed": round(shard["finished_at"] - shard["claimed_at"], 3) if "finished_at" in shard else None,
+            "fetch": fetch.get("summary"),
+        }
+
+    # 終わっていないシャードの銘柄: 前回の出力 (同じ順に並んでいる) から行を取り出して補う
+    missing = {code for shard in unfinished for code in shard["codes"]}
+    if missing:
+        previous = [row for row in load_json(output_file, []) if row['コード'] in missing]
+        sources.append(previous)
+        fallback_status = "stale" if on_missing == "stale" else "last_good"
+        for code in sorted(missing):
+            dates = [row['日付'] for row in previous if row['コード'] == code]
+            sectors[code] = {
+                "name": universe.get(code, code),
+                "status": fallback_status if dates else "missing",
+                "as_of": max(dates) if dates else None,
+            }
+
+    tmp_path = f"{output_file}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        count = write_rows(heapq.merge(*sources, key=lambda row: (row['日付'], row['コード']), reverse=True), f)
+    os.replace(tmp_path, output_file)
+    print(f"シャード: {len(done)}個の部分結果をマージし、{count}件のデータを '{output_file}' に保存しました。")
+
+    write_metadata({
+        "generated_at": datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        "missing_policy": on_missing,
+        "partial": partial,
+        "sectors": dict(sorted(sectors.items())),
+        "fetch": {"failed": sorted(failed)},
+        "shards": {
+            "done": len(done),
+            "unfinished": [shard["id"] for shard in unfinished],
+            "stats": shard_stats,
+        },
+    }, meta_file)
+    if not partial:
+        save_snapshot(output_file, meta_file, snapshot_dir)
+    return not partial
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.universe_size > len(SECTOR_ETFS) and "replay" not in args.provider.split(","):
+        print("エラー: --universe-size の拡張は --provider replay でのみ使用できます")
+        exit(1)
+    if args.backend:
+        try:
+            indicators.set_backend(args.backend)
+        except ValueError as e:
+            print(f"警告: {e} ({indicators.get_backend()} で計算します)")
+    universe = build_universe(args.universe_size)
+
+    # --- シャード分割: 計画・ワーカー・マージ (取得・計算はワーカーが起動する別プロセスで行う) ---
+    if args.shard_plan or args.shard_worker or args.shard_merge:
+        queue = shard_queue.ShardQueue(args.queue_dir)
+        if args.shard_plan:
+            plan_shards(universe, args.shard_plan, queue)
+        failures = run_shard_worker(args) if args.shard_worker else 0
+        if args.shard_merge:
+            merge_shards(queue, universe, args.output, args.meta_output, args.on_missing, args.snapshot_dir)
+        if failures:
+            exit(1)
+        return
+    if args.codes:
+        codes = args.codes.split(",")
+        unknown = [code for code in codes if code not in universe]
+        if unknown:
+            print(f"エラー: 対象外のコードです ({', '.join(unknown)})")
+            exit(1)
+        universe = {code: universe[code] for code in codes}
+
     print("セクターデータの取得を開始します...")
+    tickers = {f"{code}.T": code for code in universe}
+    provider = providers.make_provider(
+        args.provider, record_dir=args.record_dir,
+        latency=args.replay_latency, jitter=args.replay_jitter,
+        failure_rate=args.replay_failure_rate, seed=args.replay_seed,
+        synthesize=args.universe_size > len(SECTOR_ETFS),
+        csv_dir=args.csv_dir, failover_timeout=args.failover_timeout, race=args.race,
+        single_flight=True, cache_dir=args.cache_dir if args.cache else None,
+        cache_max_mb=args.cache_max_mb,
+        max_concurrency=args.concurrency if args.fixed_concurrency else args.max_concurrency
+    )
+    # 接続プールの大きさを取得の同時実行数の上限に合わせる
+    http_session.configure(args.concurrency if args.fixed_concurrency else args.max_concurrency)
+    breakers = fetch_engine.CircuitBreakers(os.path.join(args.state_dir, "breakers.json"))
+    output_file = args.output
+    # 前回の出力 (取得・計算できなかった銘柄の補完と逐次計算に使う)。シャードのワーカーはマージ済みの出力を読む
+    previous_file = args.previous_output or output_file
+    ledger_path = os.path.join(args.state_dir, "ledger.json")
+    run_deadline = Deadline.from_env(args.deadline)
+    if run_deadline.remaining() is not None:
+        print(f"実行期限まで残り {run_deadline.remaining():.0f}秒")
+
+    # --- 再開モード: 当日の台帳で失敗・欠損となっている銘柄だけを取り直す ---
+    existing_rows, previous_meta, resume_ledger = [], {}, None
+    if args.resume:
+        ledger = load_json(ledger_path, {})
+        existing_rows = load_json(output_file, [])
+        previous_meta = load_json(args.meta_output, {})
+        if ledger.get("run_date") != today_jst() or not existing_rows:
+            print("再開できる当日の台帳・出力がありません。全銘柄を取得します。")
+            existing_rows, previous_meta = [], {}
+        else:
+            # 再開するかどうかは台帳と出力で決める (メタデータが無くても台帳の他の銘柄は残す)
+            resume_ledger = ledger
+            existing_codes = {row['コード'] for row in existing_rows}
+            targets = select_resume_targets(tickers, ledger, existing_codes)
+            if not targets:
+                print("再開: 取り直しが必要な銘柄はありません。")
+                return
+            print(f"再開: {len(targets)}/{len(tickers)}銘柄を取り直します ({', '.join(targets)})")
+            tickers = {t: tickers[t] for t in targets}
+            # 取り直す銘柄は直前の失敗でサーキットが開いているため、閉じてから取得する
+            breakers.reset(targets)
 
-    # --- データ取得 (並列処理) ---
-    all_rows = []
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        futures = [executor.submit(get_sector_data, code, name) for code, name in SECTOR_ETFS.items()]
-        for future in futures:
-            res = future.result()
-            if res:
-                all_rows.extend(res)
+    # 投稿の時間を残した期限を計算の期限とし、さらに計算・保存の時間を残した期限を取得の期限とする
+    work_deadline = run_deadline.reserve(args.publish_reserve)
+    fetch_deadline = work_deadline.reserve(args.compute_reserve)
+
+    # --- 引け確認: 当日の足が出た時点で取得を始める (前日の数値を当日分として出さない) ---
+    if args.wait_for_close:
+        if not wait_for_close(list(tickers), provider, fetch_deadline, args.batch_size):
+            print("エラー: 当日の足が確認できないため、出力せずに終了します")
+            exit(2)
+
+    lean = args.lean or args.float32
+    dtype = np.float32 if args.float32 else None
+    pipeline = None
+    if args.pipeline and not args.latest_only:
+        if args.engine == "stream":
+            print("警告: --pipeline は --engine stream と併用できません (無視します)")
+        else:
+            # 取得できた銘柄から順に計算を始める
+            pipeline = ComputePipeline(tickers, universe, args.engine, lean, dtype)
+
+    histories, fetch_stats, summary = fetch_universe(
+        tickers, args, provider, breakers, fetch_deadline, on_result=pipeline.submit if pipeline else None
+    )
+
+    failed = sorted(t for t in tickers if t not in histories)
+    if failed:
+        print(f"警告: 取得に失敗した銘柄があります ({len(failed)}件, 方針: {args.on_missing})")
+        for ticker in failed:
+            error = fetch_stats.get(ticker, {}).get("error")
+            print(f"  {ticker}: {error}")
+        if args.on_missing == "fail":
+            print("エラー: 取得に失敗した銘柄があるため、出力せずに終了します")
+            exit(1)
+
+    # --- 部分結果の扱い: 保存済みの最後の正常データで補う ---
+    fallbacks = fallback_histories(failed, args.store_dir)
+    fallback_status = "stale" if args.on_missing == "stale" else "last_good"
+    histories.update(fallbacks)
+    if pipeline is not None:
+        for ticker, hist in fallbacks.items():
+            pipeline.submit(ticker, hist)
+
+    # --- 最新の足だけの計算: 窓の分だけを使って最新の1行を出し、通常の出力・状態は更新しない ---
+    if args.latest_only:
+        started = time.perf_counter()
+        latest = get_latest_data(
+            {code: histories[ticker] for ticker, code in tickers.items() if ticker in histories}, universe
+        )
+        elapsed = time.perf_counter() - started
+        latest_path = latest_file(output_file)
+        save_json([rows[0] for code, rows in sorted(latest.items())], latest_path)
+        print(f"最新の足のみ計算: {len(latest)}/{len(tickers)}銘柄 ({elapsed:.3f}秒) を '{latest_path}' に保存しました。")
+        return
+
+    # --- 指標計算 ---
+    rows_by_code = {}
+    rendered = None
+    engine = args.engine
+    if pipeline is not None:
+        # 取得と並行して進めた計算の結果を受け取る
+        rows_by_code, rendered = pipeline.collect(work_deadline)
+        print(f"パイプライン: 最初の銘柄の計算完了 {pipeline.first_done or 0:.3f}秒, "
+              f"全体 {time.monotonic() - pipeline.started:.3f}秒")
+        engine = "pipeline"
+    stream_stats = None
+    stream_path = os.path.join(args.state_dir, STREAM_STATE_FILE)
+    if engine == "stream":
+        # 前回の出力と状態に、新しい足の分だけを追加する
+        states = load_json(stream_path, {}).get("tickers", {})
+        previous_output = {}
+        for row in existing_rows or load_json(previous_file, []):
+            previous_output.setdefault(row['コード'], []).append(row)
+        rows_by_code, new_states, stream_stats = stream_sector_data(
+            {code: histories[ticker] for ticker, code in tickers.items() if ticker in histories},
+            universe, previous_output, states, verify=args.verify_stream
+        )
+        states.update(new_states)
+        print(
+            f"逐次計算: 追加 {stream_stats['appended']}行, 作り直し {len(stream_stats['rebuilt'])}銘柄, "
+            f"照合 {len(stream_stats['verified'])}銘柄"
+        )
+        if stream_stats["mismatches"]:
+            print(f"警告: 逐次計算と再計算の結果が一致しません ({len(stream_stats['mismatches'])}銘柄)")
+            for mismatch in stream_stats["mismatches"]:
+                print(f"  {mismatch}")
+
+    if engine == "panel":
+        # 全銘柄を2次元配列にまとめて1回で計算する
+        try:
+            rows_by_code = get_panel_data(
+                {code: histories[ticker] for ticker, code in tickers.items() if ticker in histories}, universe,
+                lean=lean, dtype=dtype, workers=args.compute_workers
+            )
+        except Exception as e:
+            print(f"パネル計算エラー: {e} (銘柄ごとの計算に切り替えます)")
+            engine = "frame"
+
+    if engine == "frame":
+        rows_by_code = compute_per_ticker(histories, tickers, universe, work_deadline, lean=lean, dtype=dtype)
+
+    backend_report = None
+    if args.verify_backends:
+        backend_report = verify_backends(
+            {code: histories[ticker] for ticker, code in tickers.items() if ticker in histories}
+        )
+        for backend, result in backend_report.items():
+            status = f"不一致 {len(result['mismatches'])}件" if result["mismatches"] else "一致"
+            print(f"計算カーネル {backend}: {result['seconds']}秒, pandas との照合 {status}")
+            for mismatch in result["mismatches"][:10]:
+                print(f"  {mismatch}")
+
+    # --- 取得・計算できなかった銘柄は前回出力した行 (最後に保存された正常データ) で補う ---
+    # (再開時は既存の出力をそのまま残すので、ここでは補わない)
+    previous_rows = {}
+    missing_codes = [code for code in tickers.values() if code not in rows_by_code]
+    if missing_codes and args.on_missing == "fail":
+        print("エラー: 期限内に計算できなかった銘柄があるため、出力せずに終了します")
+        exit(1)
+    if missing_codes and not existing_rows:
+        for row in load_json(previous_file, []):
+            if row['コード'] in missing_codes:
+                previous_rows.setdefault(row['コード'], []).append(row)
+
+    # --- セクターごとの判定結果 (下流で欠損・未更新を判断できるよう記録する) ---
+    sectors = {}
+    for ticker, code in tickers.items():
+        if code in previous_rows:
+            status, as_of = fallback_status, max(row['日付'] for row in previous_rows[code])
+        elif code not in rows_by_code:
+            status, as_of = "missing", None
+        else:
+            status = fallback_status if ticker in fallbacks else "fresh"
+            as_of = histories[ticker].index[-1].strftime('%Y-%m-%d')
+        sectors[code] = {"name": universe[code], "status": status, "as_of": as_of}
+    rows_by_code.update(previous_rows)
+
+    # 再開時は取り直せた銘柄の行だけを差し替え、それ以外は既存の出力を残す
+    all_rows = [row for row in existing_rows if row['コード'] not in rows_by_code]
+    for rows in rows_by_code.values():
+        all_rows.extend(rows)
+    if resume_ledger is not None:
+        # 取り直さなかった銘柄の判定は前回のメタデータから、メタデータに無ければ台帳から引き継ぐ
+        codes = {f"{code}.T": code for code in universe}
+        merged = {
+            codes[ticker]: {"name": universe[codes[ticker]], "status": entry.get("status"), "as_of": entry.get("as_of")}
+            for ticker, entry in resume_ledger.get("tickers", {}).items() if ticker in codes
+        }
+        merged.update(previous_meta.get("sectors", {}))
+        for code, info in sectors.items():
+            if info["status"] != "missing" or code not in merged:
+                merged[code] = info
+        sectors = merged
+
+    degraded = {code: v["status"] for code, v in sectors.items() if v["status"] != "fresh"}
+    if degraded:
+        print(f"部分結果: {degraded}")
 
     # ソート: 日付(新しい順) > コード順
     all_rows.sort(key=lambda x: (x['日付'], x['コード']), reverse=True)
 
     # --- JSONファイルへの保存 ---
-    output_file = 'sector_data.json'
     try:
         with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(all_rows, f, ensure_ascii=False, indent=2)
+            write_rows(all_rows, f, rendered)
         
         print(f"データ取得完了: {len(all_rows)}件のデータを '{output_file}' に保存しました。")
         
@@ -139,5 +1510,76 @@ def main():
         print(f"ファイル保存エラー: {e}")
         exit(1)
 
+    write_metadata({
+        "generated_at": datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        "provider": args.provider,
+        "provider_stats": getattr(provider, "stats", None),
+        "single_flight": getattr(provider, "flights", None),
+        "response_cache": getattr(providers.without_single_flight(provider), "cache_stats", None),
+        "missing_policy": args.on_missing,
+        "partial": bool(degraded),
+        "resumed": sorted(tickers) if resume_ledger is not None else None,
+        "sectors": sectors,
+        "fetch": {"summary": summary, "failed": failed, "tickers": fetch_stats},
+        "stream": stream_stats,
+        "indicator_backend": indicators.get_backend(),
+        "memory": {"lean": lean, "dtype": "float32" if dtype else "float64", "peak_rss_mb": peak_rss_mb()},
+        "backends": backend_report,
+    }, args.meta_output)
+
+    if stream_stats is not None:
+        save_json({"updated_at": datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), "tickers": states},
+                  stream_path, indent=None)
+
+    # スナップショットは全銘柄の出力だけを保存する (シャードの部分結果はマージ後に保存する)
+    if not degraded and not args.codes:
+        save_snapshot(output_file, args.meta_output, args.snapshot_dir)
+
+    # --- 取得台帳: 次回 --resume で取り直す銘柄を判断するために残す ---
+    entries = dict(resume_ledger["tickers"]) if resume_ledger is not None else {}
+    for ticker, code in tickers.items():
+        stat = fetch_stats.get(ticker, {})
+        entries[ticker] = {
+            "status": sectors[code]["status"],
+            "attempts": stat.get("attempts"),
+            "error": stat.get("error"),
+            "as_of": sectors[code]["as_of"],
+        }
+    save_json({
+        "run_date": today_jst(),
+        "updated_at": datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        "tickers": entries,
+    }, ledger_path)
+
+def exit_without_joining(code):
+    """
+    終了する。期限で打ち切った取得・計算のスレッドが残っている場合はその終了を待たない
+    (ThreadPoolExecutor のスレッドはインタプリタ終了時に join されるため、応答しない通信が残ると
+    出力を書き終えていても期限を過ぎるまでプロセスが終わらず、投稿側の待ち時間を使い切ってしまう)
+    プロバイダのスレッドプールを閉じて待機中のスレッドを終わらせ、EXIT_GRACE 秒待っても残るスレッド
+    (実行中の取得) がある場合だけ強制終了する
+    """
+    providers.shutdown_executors()
+    grace = Deadline.after(EXIT_GRACE)
+    others = [t for t in threading.enumerate() if t is not threading.main_thread() and not t.daemon]
+    for t in others:
+        t.join(grace.timeout(EXIT_GRACE))
+    hung = [t for t in others if t.is_alive()]
+    if not hung:
+        http_session.close()
+        sys.exit(code)
+    print(f"警告: 応答のない {len(hung)}スレッドの終了を待たずに終了します")
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code)
+
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+        exit_code = 0
+    except SystemExit as e:
+        exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except Exception:
+        traceback.print_exc()
+        exit_code = 1
+    exit_without_joining(exit_code)
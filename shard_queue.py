@@ -0,0 +1,145 @@
+import json
+import os
+import shutil
+import time
+import uuid
+
+# --- 設定: シャードのファイルキュー ---
+# 銘柄を分けたシャードをディレクトリ間のファイル移動 (os.rename、同じファイルシステム内でアトミック) で受け渡す
+#   pending/  未処理のシャード
+#   claimed/  ワーカーが取り出したシャード (1つのシャードを取り出せるのは1ワーカーだけ)
+#             ファイル名に取り出しごとの識別子 (token) を付け ('{id}.{token}.json')、完了・失敗の移動は
+#             自分の token のファイルに対してだけ行う (未処理に戻された後に他のワーカーが取り出したシャードを動かさない)
+#   done/     処理が終わったシャード
+#   failed/   再試行しても失敗したシャード
+#   results/  ワーカーが書いた部分結果 (シャードごとの出力とメタデータ)
+# 1台で試す場合はローカルのディレクトリ、複数台で分ける場合は共有ファイルシステム上のディレクトリを使う
+CLAIM_TIMEOUT = 1800         # 取り出したまま終わらないシャードを未処理に戻すまでの時間 (秒)
+MAX_ATTEMPTS = 2             # 1つのシャードを処理する最大回数 (超えたら failed に移す)
+STATES = ["pending", "claimed", "done", "failed"]
+
+
+class ShardQueue:
+    """ディレクトリをキューとして使い、シャードをワーカーに1つずつ割り当てる"""
+
+    def __init__(self, root):
+        self.root = root
+        for name in STATES + ["results"]:
+            os.makedirs(os.path.join(root, name), exist_ok=True)
+
+    def _path(self, state, shard_id):
+        return os.path.join(self.root, state, f"{shard_id}.json")
+
+    def _claimed_path(self, shard):
+        return os.path.join(self.root, "claimed", f"{shard['id']}.{shard['token']}.json")
+
+    def _read(self, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _write(self, path, shard):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(shard, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+
+    def reset(self):
+        """キューと部分結果を空にする (新しい実行の計画前に呼ぶ)"""
+        for name in STATES + ["results"]:
+            shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+            os.makedirs(os.path.join(self.root, name), exist_ok=True)
+
+    def put(self, shard_id, codes):
+        """未処理のシャードを追加する"""
+        shard = {"id": shard_id, "codes": list(codes), "attempts": 0, "worker": None, "error": None}
+        # 書き終わってから pending に置く (書きかけのファイルを取り出させない)
+        tmp_path = os.path.join(self.root, f"{shard_id}.json.tmp")
+        self._write(tmp_path, shard)
+        os.replace(tmp_path, self._path("pending", shard_id))
+
+    def claim(self, worker):
+        """
+        未処理のシャードを1つ取り出す (無ければ None)
+        pending から claimed への移動に成功したワーカーだけがそのシャードを処理する
+        取り出しごとの token (ワーカー・取り出し時刻と共にシャードに記録する) を complete / fail で照合する
+        """
+        for name in sorted(os.listdir(os.path.join(self.root, "pending"))):
+            if not name.endswith(".json"):
+                continue
+            shard_id = name[:-len(".json")]
+            token = uuid.uuid4().hex
+            claimed = os.path.join(self.root, "claimed", f"{shard_id}.{token}.json")
+            try:
+                os.rename(self._path("pending", shard_id), claimed)
+            except FileNotFoundError:
+                continue  # 他のワーカーが先に取り出した
+            shard = self._read(claimed)
+            shard["attempts"] += 1
+            shard["worker"] = worker
+            shard["token"] = token
+            shard["claimed_at"] = time.time()
+            self._write(claimed, shard)
+            return shard
+        return None
+
+    def _release(self, shard, state):
+        """
+        自分が取り出したシャード (token が一致するもの) を state へ移す
+        未処理に戻された・他のワーカーが取り出し直したなどで所有していない場合は何もせず False を返す
+        """
+        # 自分の token のファイルを作業用の名前へ移せた時点で所有が確定する (他のワーカーからは見えなくなる)
+        staged = os.path.join(self.root, f"{shard['id']}.{shard['token']}.json.tmp")
+        try:
+            os.rename(self._claimed_path(shard), staged)
+        except FileNotFoundError:
+            return False
+        self._write(staged, shard)
+        os.replace(staged, self._path(state, shard["id"]))
+        return True
+
+    def complete(self, shard):
+        """処理が終わったシャードを done に移す (所有していなければ False)"""
+        shard["finished_at"] = time.time()
+        return self._release(shard, "done")
+
+    def fail(self, shard, error):
+        """
+        失敗したシャードを未処理に戻す (MAX_ATTEMPTS 回失敗したら failed に移す)
+        戻り値: 移した状態 (所有していなければ None)
+        """
+        shard["error"] = error
+        state = "failed" if shard["attempts"] >= MAX_ATTEMPTS else "pending"
+        return state if self._release(shard, state) else None
+
+    def requeue_stale(self, timeout=CLAIM_TIMEOUT):
+        """取り出されたまま timeout 秒を過ぎたシャード (ワーカーが落ちたものなど) を未処理に戻す"""
+        requeued = []
+        now = time.time()
+        for shard in self.list("claimed"):
+            if now - shard.get("claimed_at", now) > timeout:
+                try:
+                    os.rename(self._claimed_path(shard), self._path("pending", shard["id"]))
+                except FileNotFoundError:
+                    continue
+                requeued.append(shard["id"])
+        return requeued
+
+    def list(self, state):
+        """指定した状態のシャードの一覧 (id 順)"""
+        shards = []
+        directory = os.path.join(self.root, state)
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".json"):
+                try:
+                    shards.append(self._read(os.path.join(directory, name)))
+                except (FileNotFoundError, json.JSONDecodeError):
+                    continue  # 移動・書き込みの途中
+        return shards
+
+    def counts(self):
+        return {state: len(self.list(state)) for state in STATES}
+
+    def result_paths(self, shard_id):
+        """シャードの部分結果 (出力, メタデータ) のパス"""
+        results = os.path.join(self.root, "results")
+        return os.path.join(results, f"{shard_id}.json"), os.path.join(results, f"{shard_id}.meta.json")
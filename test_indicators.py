@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import indicators
+import sector_analysis
+
+# --- 計算カーネルの照合 ---
+# 全ての計算カーネル (numba / numpy) のパネル計算が、銘柄ごとの pandas 計算 (calculate_technical_indicators) と
+# ビット単位で一致することを確かめる。NaN・inf・横ばい・負の値・助走期間に満たない短い履歴を含める
+# numba が無い環境では numba の照合を飛ばす
+BARS = 400
+
+
+def make_history(close, volume=None, seed=0):
+    """終値の配列から OHLCV のデータフレームを作る"""
+    close = np.asarray(close, dtype=float)
+    rng = np.random.default_rng(seed)
+    if volume is None:
+        volume = rng.integers(1_000, 100_000, len(close)).astype(float)
+    index = pd.bdate_range("2024-01-01", periods=len(close))
+    return pd.DataFrame({
+        "Open": close, "High": close * 1.01, "Low": close * 0.99, "Close": close, "Volume": volume,
+    }, index=index)
+
+
+def random_walk(seed, bars=BARS, start=1000.0):
+    rng = np.random.default_rng(seed)
+    return start + np.cumsum(rng.normal(0, 5, bars))
+
+
+def edge_histories():
+    """照合に使う銘柄 (キー: 内容)"""
+    with_nan = random_walk(1)
+    with_nan[[50, 51, 200, 390]] = np.nan
+    with_inf = random_walk(2)
+    with_inf[[120, 300]] = [np.inf, -np.inf]
+    flat = random_walk(3)
+    flat[150:190] = flat[149]
+    zero_volume = np.zeros(BARS)
+    zero_volume[::7] = 5_000.0
+    return {
+        "walk": make_history(random_walk(0)),
+        "nan": make_history(with_nan, seed=1),
+        "inf": make_history(with_inf, seed=2),
+        "flat": make_history(flat, seed=3),
+        "constant": make_history(np.full(BARS, 500.0), seed=4),
+        "negative": make_history(random_walk(5, start=-50.0), seed=5),
+        "zero_volume": make_history(random_walk(6), volume=zero_volume),
+        "short": make_history(random_walk(7, bars=30), seed=7),
+        "tiny": make_history(random_walk(8, bars=3), seed=8),
+    }
+
+
+@pytest.fixture(params=indicators.BACKENDS)
+def backend(request):
+    if request.param not in indicators.available_backends():
+        pytest.skip(f"{request.param} が使用できません")
+    current = indicators.get_backend()
+    indicators.set_backend(request.param)
+    yield request.param
+    indicators.set_backend(current)
+
+
+def test_panel_matches_pandas(backend):
+    histories = edge_histories()
+    codes, _, values, _ = sector_analysis.panel_values(histories)
+    rows = sector_analysis.required_bars()
+    for j, code in enumerate(codes):
+        expected = sector_analysis.calculate_technical_indicators(histories[code].tail(rows))
+        for column in sector_analysis.OUTPUT_INDICATORS:
+            actual = values[column][len(values[column]) - len(expected):, j]
+            assert np.array_equal(actual, expected[column].to_numpy(dtype=float), equal_nan=True), \
+                f"{backend}: {code} の {column} が pandas と一致しません"
+
+
+@pytest.mark.parametrize("window", [1, 5, 14, 20, 75])
+def test_rolling_kernels_match_pandas(backend, window):
+    histories = edge_histories()
+    panel = np.column_stack([df["Close"].to_numpy()[-100:] for df in histories.values() if len(df) >= 100])
+    expected = pd.DataFrame(panel).rolling(window=window)
+    assert np.array_equal(indicators.rolling_mean(panel, window), expected.mean().to_numpy(), equal_nan=True)
+    assert np.array_equal(indicators.rolling_std(panel, window), expected.std().to_numpy(), equal_nan=True)
+
+
+def test_stream_matches_pandas():
+    histories = edge_histories()
+    rows = sector_analysis.required_bars()
+    for code, hist in histories.items():
+        hist = hist.tail(rows)
+        expected = sector_analysis.calculate_technical_indicators(hist)
+        stream = sector_analysis.indicator_graph().stream(names=sector_analysis.OUTPUT_INDICATORS)
+        pushed = [
+            stream.push(date.strftime("%Y-%m-%d"), {k: float(v) for k, v in bar.items()})
+            for date, bar in zip(hist.index, hist[indicators.PANEL_COLUMNS].to_dict("records"))
+        ]
+        for column in sector_analysis.OUTPUT_INDICATORS:
+            actual = np.array([out[column] for out in pushed], dtype=float)
+            assert np.array_equal(actual, expected[column].to_numpy(dtype=float), equal_nan=True), \
+                f"逐次計算: {code} の {column} が pandas と一致しません"
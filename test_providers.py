@@ -0,0 +1,72 @@
+import datetime
+
+import pandas as pd
+
+import price_store
+import providers
+
+JST = providers.JST
+
+
+def at(day, hour, minute):
+    return datetime.datetime(*day, hour, minute, tzinfo=JST)
+
+
+def frame(last_day, bars=3):
+    index = pd.bdate_range(end=last_day, periods=bars)
+    df = pd.DataFrame({"Open": 1.0, "High": 1.0, "Low": 1.0, "Close": 1.0, "Volume": 1.0}, index=index)
+    return price_store.normalize_ohlcv(df)
+
+
+def test_next_close_before_close():
+    # 金曜の取引時間中: 当日の足は確定前、期限は当日の大引け + データ遅延
+    expires, settled = providers.next_close(at((2026, 10, 16), 10, 0))
+    assert settled == datetime.date(2026, 10, 15)
+    assert expires == at((2026, 10, 16), 15, 50)
+
+
+def test_next_close_within_data_delay():
+    # 大引け直後 (データ遅延中) は当日の足をまだ確定とみなさない
+    expires, settled = providers.next_close(at((2026, 10, 16), 15, 35))
+    assert settled == datetime.date(2026, 10, 15)
+    assert expires == at((2026, 10, 16), 15, 50)
+
+
+def test_next_close_after_settle():
+    # データ遅延が過ぎたら当日が確定し、期限は次の取引日 (週明け) の大引け + データ遅延
+    expires, settled = providers.next_close(at((2026, 10, 16), 15, 50))
+    assert settled == datetime.date(2026, 10, 16)
+    assert expires == at((2026, 10, 19), 15, 50)
+
+
+def test_next_close_holiday():
+    # 祝日 (2026-11-03 文化の日) は前の取引日が確定済み
+    expires, settled = providers.next_close(at((2026, 11, 3), 12, 0))
+    assert settled == datetime.date(2026, 11, 2)
+    assert expires == at((2026, 11, 4), 15, 50)
+
+
+def cache(tmp_path):
+    return providers.CachingProvider(providers.CsvDropProvider(str(tmp_path / "csv")), str(tmp_path / "cache"))
+
+
+def test_store_keeps_settled_response(tmp_path):
+    provider = cache(tmp_path)
+    # 読み出しは実際の時刻で期限を判定するため、期限を十分先にする
+    expires = datetime.datetime.now(JST) + datetime.timedelta(days=1)
+    provider._store(["k"], None, {"A": frame("2026-10-16")}, expires, datetime.date(2026, 10, 16))
+    assert provider.cache_stats["stored"] == 1
+    assert list(provider._load(["k"], None)) == ["A"]
+
+
+def test_store_skips_unsettled_response(tmp_path):
+    provider = cache(tmp_path)
+    expires = datetime.datetime.now(JST) + datetime.timedelta(days=1)
+    settled = datetime.date(2026, 10, 15)
+    # 確定前の当日の足を含む応答
+    provider._store(["provisional"], None, {"A": frame("2026-10-16")}, expires, settled)
+    # 確定済みの取引日の足がまだ無い銘柄を含む応答
+    provider._store(["missing"], None, {"A": frame("2026-10-15"), "B": frame("2026-10-14")}, expires, settled)
+    assert provider.cache_stats["stored"] == 0
+    assert provider._load(["provisional"], None) is None
+    assert provider._load(["missing"], None) is None
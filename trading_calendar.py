@@ -0,0 +1,47 @@
+import datetime
+
+import jpholiday
+
+# --- 設定: 東証の取引日 ---
+# 土日・祝日 (jpholiday) と年末年始 (12/31〜1/3) を休場とする
+YEAR_END_HOLIDAYS = {(12, 31), (1, 1), (1, 2), (1, 3)}
+
+
+def is_trading_day(day):
+    """day (date / datetime) が東証の取引日かどうか"""
+    if isinstance(day, datetime.datetime):
+        day = day.date()
+    if day.weekday() >= 5 or (day.month, day.day) in YEAR_END_HOLIDAYS:
+        return False
+    if jpholiday.is_holiday(day):
+        return False
+    return True
+
+
+def next_trading_day(day):
+    """day より後の最初の取引日"""
+    day += datetime.timedelta(days=1)
+    while not is_trading_day(day):
+        day += datetime.timedelta(days=1)
+    return day
+
+
+def previous_trading_day(day):
+    """day より前の最後の取引日"""
+    day -= datetime.timedelta(days=1)
+    while not is_trading_day(day):
+        day -= datetime.timedelta(days=1)
+    return day
+
+
+def sessions_back(end, count):
+    """
+    end (その日を含む) から数えて count 本目の取引日を返す
+    end が休場日の場合は直前の取引日から数える
+    """
+    if isinstance(end, datetime.datetime):
+        end = end.date()
+    day = end if is_trading_day(end) else previous_trading_day(end)
+    for _ in range(count - 1):
+        day = previous_trading_day(day)
+    return day
@@ -5,6 +5,22 @@ import base64
 import datetime
 import pandas as pd
 import random
+import argparse
+import shlex
+import subprocess
+import sys
+
+import http_session
+from deadline import Deadline
+
+# 投稿リクエストのタイムアウト (秒)。実行期限 (RUN_DEADLINE) が近い場合はその残り時間に縮める
+PUBLISH_TIMEOUT = 30
+PUBLISH_MIN_TIMEOUT = 5
+# 投稿は1件ずつ行うため、共有セッションの接続プールは1接続でよい
+PUBLISH_POOL_SIZE = 1
+
+# 最後に全セクターを正常に取得できたデータの置き場所 (sector_analysis.py が保存する)
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", "snapshots")
 
 # gspread や google.oauth2 などのスプレッドシート関連ライブラリは不要になりました
 
@@ -24,6 +40,30 @@ def get_analysis_data(file_path='sector_data.json'):
     except Exception as e:
         raise Exception(f"JSONファイルの読み込みに失敗しました: {e}")
 
+def latest_file(data_path):
+    """
+    sector_analysis.py --latest-only が保存する最新の足の行 (日中のパネル更新用) のパス
+    データファイルと同じ場所の '{名前}_latest.json' (sector_analysis.latest_file と同じ規則)
+    """
+    base, ext = os.path.splitext(data_path)
+    if base.endswith("_data"):
+        base = base[:-len("_data")]
+    return f"{base}_latest{ext}"
+
+def get_run_metadata(file_path='sector_meta.json'):
+    """
+    前工程の実行メタデータ (セクターごとの鮮度・欠損の判定) を読み込む
+    ファイルが無い・壊れている場合は空の辞書を返す (メタデータが無くても投稿は続ける)
+    """
+    if not os.path.exists(file_path):
+        return {}
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"メタデータの読み込みに失敗しました (無視して続行): {e}")
+        return {}
+
 def process_data_for_chart(data):
     """
     取得したデータを加工する
@@ -119,8 +159,14 @@ def process_data_for_chart(data):
 
     return latest_df, chart_labels, chart_datasets, overheated_top3
 
-def generate_html_content(latest_df, chart_labels, chart_datasets, overheated_top3):
-    """HTMLコンテンツ（パネル＋Chart.jsスクリプト）を生成"""
+def generate_html_content(latest_df, chart_labels, chart_datasets, overheated_top3, sector_status=None,
+                          stale_notice=None):
+    """
+    HTMLコンテンツ（パネル＋Chart.jsスクリプト）を生成
+    sector_status (メタデータの sectors) があれば、未更新のセクターに注記し、欠損セクターも枠を表示する
+    stale_notice があれば、前回データを表示中である旨を冒頭に表示する
+    """
+    sector_status = sector_status or {}
     
     if latest_df is None or latest_df.empty:
         return "<p>データがありません。</p>"
@@ -129,6 +175,14 @@ def generate_html_content(latest_df, chart_labels, chart_datasets, overheated_to
     last_update_str = latest_df['日付'].max().strftime('%Y-%m-%d')
     chart_id = f"sectorChart_{random.randint(1000, 9999)}"
 
+    # 前回データを表示中の注記 (stale-while-revalidate)
+    stale_html = ""
+    if stale_notice:
+        stale_html = (
+            '<div style="font-size: 0.8rem; color: #e65100; background: #fff3e0; padding: 8px 12px; '
+            f'border-radius: 6px; margin-bottom: 10px; border: 1px solid #ffe0b2;">{stale_notice}</div>'
+        )
+
     # --- CSS (インライン) ---
     style_grid = "display: grid; grid-template-columns: 1fr 1fr; gap: 10px; margin-bottom: 20px;"
     # style_cardの定義はループ内で動的に行うため削除
@@ -136,6 +190,7 @@ def generate_html_content(latest_df, chart_labels, chart_datasets, overheated_to
     html = f"""
     <div style="font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif; max-width: 800px; margin: 0 auto;">
         <p style="text-align: right; font-size: 0.8rem; color: #666; margin-bottom: 10px;">データ更新日: {last_update_str}</p>
+        {stale_html}
         
         <h3 style="font-size: 1.1rem; margin-bottom: 15px; color: #333;">短期の過熱割安判定パネル</h3>
 
@@ -144,6 +199,7 @@ def generate_html_content(latest_df, chart_labels, chart_datasets, overheated_to
 
     for _, row in latest_df.iterrows():
         sector = row['セクター名']
+        status_info = sector_status.get(str(row['コード']), {})
         change = float(row['前日比(%)'])
         rsi = float(row['RSI'])
         bb = float(row['BB%B(過熱)'])
@@ -187,13 +243,21 @@ def generate_html_content(latest_df, chart_labels, chart_datasets, overheated_to
         change_color = "#d32f2f" if change > 0 else ("#1976d2" if change < 0 else "#333")
         sign = "+" if change > 0 else ""
         
+        # 取得に失敗し、前回までのデータで表示しているセクターは注記する
+        stale_html = ""
+        if status_info.get("status") == "stale":
+            stale_html = (
+                f'<span style="font-weight: normal; font-size: 0.7rem; color: #e65100; margin-left: 6px;">'
+                f'データ未更新 ({status_info.get("as_of")}時点)</span>'
+            )
+
         # パネルのスタイルを動的に生成
         current_card_style = f"padding: 12px; border-radius: 6px; background: {card_bg}; box-shadow: 0 1px 3px rgba(0,0,0,0.1); border: {card_border};"
         
         # パネルHTML
         html += f"""
         <div style="{current_card_style}">
-            <div style="font-weight: bold; font-size: 0.95rem; color: #333; margin-bottom: 8px;">{sector}</div>
+            <div style="font-weight: bold; font-size: 0.95rem; color: #333; margin-bottom: 8px;">{sector}{stale_html}</div>
             
             <div style="display: flex; justify-content: space-between; align-items: center; margin-bottom: 8px;">
                 <div>
@@ -214,6 +278,18 @@ def generate_html_content(latest_df, chart_labels, chart_datasets, overheated_to
         </div>
         """
 
+    # データを取得できなかったセクターも枠だけ表示する (パネルが黙って欠けないように)
+    shown_codes = set(latest_df['コード'].astype(str))
+    for code, info in sorted(sector_status.items()):
+        if info.get("status") != "missing" or code in shown_codes:
+            continue
+        html += f"""
+        <div style="padding: 12px; border-radius: 6px; background: #fafafa; border: 1px dashed #ccc;">
+            <div style="font-weight: bold; font-size: 0.95rem; color: #999; margin-bottom: 8px;">{info.get('name', code)}</div>
+            <div style="font-size: 0.8rem; color: #999;">データを取得できませんでした</div>
+        </div>
+        """
+
     # パネル下の説明エリア
     html += """
         </div>
@@ -343,8 +419,9 @@ def get_wordpress_config():
             elif key == "WP_PAGE_ID": config["page_id"] = value
     return config
 
-def update_wordpress(content):
-    """WordPress更新"""
+def update_wordpress(content, deadline=None):
+    """WordPress更新 (応答しない接続で止まらないよう、実行期限に合わせたタイムアウトを付ける)"""
+    deadline = deadline or Deadline(None)
     wp_config = get_wordpress_config()
     wp_url = wp_config["url"]
     wp_user = wp_config["user"]
@@ -353,7 +430,7 @@ def update_wordpress(content):
 
     if not all([wp_url, wp_user, wp_pass, page_id]):
         print("エラー: WordPress設定不足")
-        return
+        return False
 
     api_url = f"{wp_url.rstrip('/')}/wp-json/wp/v2/pages/{page_id}"
     credentials = f"{wp_user}:{wp_pass}"
@@ -364,31 +441,141 @@ def update_wordpress(content):
     }
     payload = {'content': content}
 
-    print(f"WordPress ({api_url}) へ投稿中...")
-    response = requests.post(api_url, headers=headers, json=payload)
+    timeout = deadline.timeout(PUBLISH_TIMEOUT, minimum=PUBLISH_MIN_TIMEOUT)
+    print(f"WordPress ({api_url}) へ投稿中... (タイムアウト {timeout:.0f}秒)")
+    try:
+        # 共有セッション (Keep-Alive・接続プール) で投稿する
+        response = http_session.get_session().post(api_url, headers=headers, json=payload, timeout=timeout)
+    except requests.exceptions.Timeout:
+        print(f"投稿失敗: {timeout:.0f}秒以内に応答がありませんでした")
+        raise
 
     if response.status_code == 200:
         print("投稿成功！")
+        return True
     else:
         print(f"投稿失敗: {response.status_code}")
         print(response.text)
+        return False
+
+def build_page(data_path='sector_data.json', meta_path='sector_meta.json', stale_notice=None,
+               overlay_latest=True):
+    """
+    データファイルとメタデータから投稿用HTMLを組み立てる
+    overlay_latest=True の場合、データファイルに対応する --latest-only の出力があり、
+    その日付がデータファイルの最終日より新しければ、その行を重ねる (古い・同じ日付の行は使わない)
+    """
+    raw_data = get_analysis_data(data_path)
+    latest_path = latest_file(data_path)
+    if overlay_latest and os.path.exists(latest_path):
+        try:
+            latest_rows = get_analysis_data(latest_path)
+            as_of = max((row['日付'] for row in raw_data), default="")
+            if max((row['日付'] for row in latest_rows), default="") > as_of:
+                raw_data = raw_data + latest_rows
+        except Exception as e:
+            print(f"最新の足のデータを読み込めませんでした (無視して続行): {e}")
+    latest_df, chart_labels, chart_datasets, overheated_top3 = process_data_for_chart(raw_data)
+
+    run_meta = get_run_metadata(meta_path)
+    if run_meta.get("partial"):
+        print(f"注意: 部分結果のデータです (方針: {run_meta.get('missing_policy')})")
+
+    return generate_html_content(
+        latest_df, chart_labels, chart_datasets, overheated_top3,
+        sector_status=run_meta.get("sectors"), stale_notice=stale_notice
+    )
+
+def post_snapshot(notice, deadline):
+    """
+    前回の正常なスナップショットを notice 付きで投稿する (スナップショットが無ければ何もしない)
+    投稿の失敗 (タイムアウト・接続エラーなど) は表示するだけで例外にしない
+    """
+    snapshot_data = os.path.join(SNAPSHOT_DIR, "sector_data.json")
+    snapshot_meta = os.path.join(SNAPSHOT_DIR, "sector_meta.json")
+    if not os.path.exists(snapshot_data):
+        return False
+    try:
+        snapshot = get_analysis_data(snapshot_data)
+        as_of = max((row['日付'] for row in snapshot), default="-")
+        return update_wordpress(
+            build_page(snapshot_data, snapshot_meta, stale_notice=notice.format(as_of=as_of), overlay_latest=False),
+            deadline=deadline
+        )
+    except Exception as e:
+        print(f"スナップショットの投稿に失敗しました (無視して続行): {e}")
+        return False
+
+def publish_stale_while_revalidate(deadline, analysis_args=None):
+    """
+    前回の正常なスナップショットを「更新中」と明示して即座に投稿し、
+    並行して sector_analysis.py を実行、最新データができたら投稿し直す
+    最新データの取得に失敗・期限切れになった場合は、前回データを「更新できなかった」旨に書き換えて投稿し直す
+    前回データの投稿に失敗しても sector_analysis.py の完了を待ち、最新データの投稿は行う
+    """
+    # 1. 最新データの取得・計算を裏で開始する (実行期限は環境変数で引き継がれる)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sector_analysis.py")
+    process = subprocess.Popen([sys.executable, script, *(analysis_args or [])])
+
+    # 2. 前回の正常なスナップショットを即座に投稿する
+    if os.path.exists(os.path.join(SNAPSHOT_DIR, "sector_data.json")):
+        print("前回のスナップショットを先に投稿します...")
+        post_snapshot("{as_of} 時点のデータを表示しています。最新データは取得でき次第、自動で更新されます。", deadline)
+    else:
+        print("スナップショットがないため、最新データの完成を待って投稿します。")
+
+    # 3. 最新データを待ち、できたら投稿し直す
+    failed_notice = "{as_of} 時点のデータを表示しています。本日の最新データは取得できませんでした。"
+    try:
+        returncode = process.wait(timeout=deadline.timeout(None))
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+        print("実行期限までに最新データが完成しませんでした。前回データを「更新できなかった」表示で投稿し直します。")
+        post_snapshot(failed_notice, deadline)
+        return False
+    if returncode != 0:
+        print(f"最新データの取得に失敗しました (終了コード {returncode})。前回データを「更新できなかった」表示で投稿し直します。")
+        post_snapshot(failed_notice, deadline)
+        return False
+
+    print("最新データで投稿し直します...")
+    return update_wordpress(build_page(), deadline=deadline)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="セクター分析結果をWordPressに投稿する")
+    parser.add_argument(
+        "--stale-while-revalidate", action="store_true",
+        help="前回の正常なデータを即座に投稿し、sector_analysis.py の完了後に最新データで投稿し直す"
+    )
+    parser.add_argument(
+        "--analysis-args", default="",
+        help="--stale-while-revalidate 時に sector_analysis.py へ渡す引数 (例: '--batch-size 17')"
+    )
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
     try:
-        print("データを取得中...")
+        args = parse_args()
+        # 実行全体の期限 (ワークフローが環境変数 RUN_DEADLINE で渡す)
+        deadline = Deadline.from_env()
+        http_session.configure(PUBLISH_POOL_SIZE)
+
+        if args.stale_while_revalidate:
+            if not publish_stale_while_revalidate(deadline, shlex.split(args.analysis_args)):
+                exit(1)
+            exit(0)
+
+        print("データを取得・加工中(パネル＆チャート)...")
         # ファイルからデータを取得する形に変更
-        raw_data = get_analysis_data()
-        
-        print("データを加工中(パネル＆チャート)...")
-        latest_df, chart_labels, chart_datasets, overheated_top3 = process_data_for_chart(raw_data)
-        
-        print("HTMLコンテンツ生成中...")
-        html_content = generate_html_content(latest_df, chart_labels, chart_datasets, overheated_top3)
+        html_content = build_page()
         
-        update_wordpress(html_content)
+        update_wordpress(html_content, deadline=deadline)
         
     except Exception as e:
         print(f"エラーが発生しました: {e}")
         import traceback
         traceback.print_exc()
         exit(1)
+    finally:
+        http_session.close()